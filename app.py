@@ -1,247 +1,275 @@
 import os
 import json
-from flask import Flask, request, jsonify
-import firebase_admin
-from firebase_admin import credentials, firestore
+import time
+import atexit
+import itertools
+from datetime import date
+from flask import Flask, Response, request, jsonify
 import logging
-from datetime import datetime
-
-logging.basicConfig(level=logging.DEBUG)
+import threading
+import deadlines
+import dialogflow
+import fulfillment
+import metrics
+from circuit_breaker import CircuitBreaker, GuardedStore, StoreUnavailable
+from dialogflow import Reply, WebhookRequest
+from idempotency import ResponseCache
+from intent_router import IntentRouter
+from fulfillment import ADD_TO_ORDER_INTENT, PLACE_ORDER_INTENT, REMOVE_FROM_ORDER_INTENT, TOTAL_AMOUNT
+from log_config import configure_logging, payload_sampler
+from menu_cache import MenuCache
+from order_cache import order_cache
+from order_export import ExportQuery, export_chunks
+from order_ids import new_order_id, normalize_order_id
+from sales_counters import SalesCounters
+from storage import OrderExists, OrderNotFound, OrderRejected, create_store
+from write_behind import DeferredWrites, GroupCommitStore, WriteOutcomeUnknown
+
+configure_logging()
 
 app = Flask(__name__)
 
-def initialize_firebase():
+# Backend is picked by ORDER_STORE (firestore, memory or sqlite)
+store = metrics.InstrumentedStore(create_store())
+if os.environ.get("WRITE_BEHIND") == "1":
+    # Order writes from concurrent requests share one commit
+    store = GroupCommitStore(store)
+    metrics.register_write_behind(store)
+    atexit.register(store.close)
+# Fails store calls fast while Firestore is unhealthy, see circuit_breaker.py
+breaker = CircuitBreaker()
+store = GuardedStore(store, breaker)
+metrics.register_breaker(breaker)
+# New orders taken meanwhile, saved once the store is back
+deferred = DeferredWrites(store)
+metrics.register_deferred_writes(deferred)
+atexit.register(deferred.close)
+menu_cache = MenuCache(store)
+metrics.register_menu_cache(menu_cache)
+# Replies by Dialogflow responseId, so retried calls aren't applied twice
+response_cache = ResponseCache(store)
+metrics.register_response_cache(response_cache)
+# Recently changed orders, so Firestore order changes can skip the read
+metrics.register_order_cache(order_cache)
+# Daily revenue and item totals, updated with every order write
+sales = SalesCounters()
+# Intent name -> handler, see intent_router.py
+router = IntentRouter(lambda req: fulfillment.UNKNOWN_INTENT_REPLY, fulfillment.BUSY_REPLY)
+# Replies are kept per responseId and the handler timed, for every intent
+ORDER_MIDDLEWARE = (response_cache.middleware, metrics.time_handler)
+
+
+def warm_up():
+    # Called per worker after fork: connect to the store and load the menu
+    # off the request path
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+
+def _warm_up():
     try:
-        service_account_path = "/etc/secrets/servicekey.json"
-
-        if not firebase_admin._apps:
-            cred = credentials.Certificate(service_account_path)
-            firebase_admin.initialize_app(cred)
-
-        return firestore.client()
+        menu_cache.prices()
     except Exception as e:
-        logging.error(f"Failed to initialize Firebase: {e}")
-        raise
-
-db = initialize_firebase()
+        logging.warning("Warm-up failed: %s", e)
 
 
 @app.route('/', methods=['POST'])
 def webhook():
+    start = time.perf_counter()
+    intent = None
     try:
-        req = request.get_json()
-        logging.debug(f"Request received: {req}")
+        # Decoded once; handlers get only the fields they use
+        payload = dialogflow.loads(request.get_data(cache=False))
+        req = WebhookRequest.from_payload(payload)
 
-        intent = req.get('queryResult', {}).get('intent', {}).get('displayName', "")
-        if not intent:
-            raise ValueError("Intent not found in the request.")
+        intent = req.intent
+        if payload_sampler.sample(intent):
+            logging.info("Request received", extra={"intent": intent, "payload": payload})
 
-        if intent == "order_item_place":
-            return handle_place_order(req)
-        elif intent == "order.add - context: ongoing-order":
-            return handle_add_to_order(req)
-        elif intent == "order.remove - context: ongoing-order":
-            return handle_remove_from_order(req)
-        else:
-            return jsonify({"fulfillmentText": "I couldn't process that request."})
+        # Store calls share what is left of Dialogflow's 5 seconds
+        with deadlines.request_deadline():
+            reply = router.dispatch(req)
 
     except Exception as e:
-        logging.error(f"Error handling request: {e}")
-        return jsonify({"fulfillmentText": "An error occurred while processing your request."})
+        logging.error("Error handling request: %s", e)
+        reply = fulfillment.INTERNAL_ERROR_REPLY
 
-def handle_place_order(req):
-    try:
-        data = req.get('queryResult', {}).get('parameters', {})
-        menu_items = data.get("menu_item", [])
-        quantities = data.get("quantity", [])
-
-        if not menu_items or not isinstance(menu_items, list):
-            return jsonify({"fulfillmentText": "No valid menu items provided."})
-
-        # Initialize total amount and order details
-        total_amount = 0
-        order_details = []
+    metrics.observe_webhook(intent, reply, time.perf_counter() - start)
+    return Response(dialogflow.encode_reply(reply), content_type="application/json")
 
-        # Fetch menu prices from Firestore
-        menu_ref = db.collection("menu_prices").get()
-        menu_prices = {item.id.strip().lower(): item.to_dict().get("price") for item in menu_ref}
-
-        # Process each menu item
-        for i, item in enumerate(menu_items):
-            name = item.strip().lower()
-            quantity = int(quantities[i]) if i < len(quantities) else 1
 
-            price = menu_prices.get(name)
-            if not price:
-                return jsonify({"fulfillmentText": f"Item '{item}' is not available in the menu."})
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
-            total_amount += price * quantity
-            order_details.append({"item": item, "quantity": quantity})
 
-        order_id = f"order_{int(datetime.utcnow().timestamp())}"
-        new_order = {
-            "orderId": order_id,
-            "orderItems": order_details,
-            "totalAmount": total_amount,
-            "timestamp": datetime.now().isoformat()
-        }
+@app.route('/sales', methods=['GET'])
+def sales_endpoint():
+    # Today's totals, or those of ?day=YYYY-MM-DD
+    try:
+        day = date.fromisoformat(request.args["day"]) if "day" in request.args else None
+    except ValueError:
+        return jsonify({"error": "day must be YYYY-MM-DD"}), 400
+    try:
+        return jsonify(sales.totals(store, day))
+    except StoreUnavailable:
+        return jsonify({"error": "store unavailable"}), 503
 
-        db.collection("orders").document(order_id).set(new_order)
-        logging.info(f"Order placed successfully: {new_order}")
 
-        return jsonify({
-            "fulfillmentText": f"Your order has been placed successfully! Order ID: {order_id}. Total amount: ₹{total_amount}. If you wish to modify your order, please provide this Order ID."
-        })
+@app.route('/orders', methods=['GET'])
+def orders_endpoint():
+    # Order history as NDJSON or CSV, see order_export.py
+    try:
+        query = ExportQuery.from_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    chunks = export_chunks(store, query)
+    try:
+        first = next(chunks)
+    except StoreUnavailable:
+        return jsonify({"error": "store unavailable"}), 503
+    except Exception:
+        return jsonify({"error": "export failed"}), 500
+    return Response(
+        itertools.chain((first,), chunks),
+        content_type=query.content_type,
+        headers={"Content-Disposition": f'attachment; filename="{query.filename}"'},
+    )
+
+
+@router.intent(PLACE_ORDER_INTENT, *ORDER_MIDDLEWARE)
+def handle_place_order(req):
+    try:
+        if not req.menu_items:
+            return fulfillment.NO_ITEMS_REPLY
+
+        # Menu prices from the shared in-process cache
+        menu_prices = menu_cache.prices()
+
+        # Price each menu item and build the order lines
+        order_items, total_amount = fulfillment.price_items(req.menu_items, req.quantities, menu_prices)
+
+        order_id = new_order_id()
+        new_order = fulfillment.new_order(order_id, order_items, total_amount)
+
+        # The order and its sales counter shard in one commit
+        writes = [("create", order_id, new_order)] + sales.placed(order_items, total_amount)
+        try:
+            try:
+                store.commit_writes(writes)
+            except OrderExists:
+                # Another instance drew the same random host for its IDs
+                # (see order_ids.py); the next ID from ours won't clash
+                logging.warning("Order ID already taken, retrying with a new one", extra={"order_id": order_id})
+                order_id = new_order_id()
+                new_order = fulfillment.new_order(order_id, order_items, total_amount)
+                writes = [("create", order_id, new_order)] + sales.placed(order_items, total_amount)
+                store.commit_writes(writes)
+        except WriteOutcomeUnknown:
+            logging.warning("Order write outcome unknown", extra={"order_id": order_id, "total_amount": total_amount})
+            return fulfillment.ORDER_SAVING_REPLY(order_id=order_id, total_amount=total_amount)
+        except StoreUnavailable:
+            # Not sent: take the order now and save it once the store is back
+            if not deferred.submit(writes):
+                raise
+            logging.warning("Order deferred", extra={"order_id": order_id, "total_amount": total_amount})
+            return fulfillment.ORDER_RECEIVED_REPLY(order_id=order_id, total_amount=total_amount)
+        logging.info("Order placed successfully", extra={"order_id": order_id, "total_amount": total_amount})
+
+        return fulfillment.ORDER_PLACED_REPLY(order_id=order_id, total_amount=total_amount)
+    except OrderRejected as rejected:
+        return Reply(str(rejected))
     except Exception as e:
-        logging.error(f"Error placing order: {e}")
-        return jsonify({"fulfillmentText": "Failed to place your order. Please try again later."})
+        logging.error("Error placing order: %s", e)
+        return fulfillment.PLACE_FAILED_REPLY
 
+@router.intent(ADD_TO_ORDER_INTENT, *ORDER_MIDDLEWARE)
 def handle_add_to_order(req):
     try:
-        data = req.get('queryResult', {}).get('parameters', {})
-        new_items = data.get("menu_item", [])
-        quantities = data.get("quantity", [])
-        order_id = data.get("order_id")
-
-        if not order_id:
-            return jsonify({"fulfillmentText": "Please provide a valid Order ID to add items."})
-
-        # Validate order_id from Firestore
-        order_ref = db.collection("orders").document(order_id)
-        order = order_ref.get()
-
-        if not order.exists:
-            return jsonify({"fulfillmentText": "No order found with the provided Order ID."})
+        if not req.order_id:
+            return fulfillment.ADD_MISSING_ORDER_ID_REPLY
 
-        current_order = order.to_dict()
+        order_id = normalize_order_id(req.order_id)
 
         # Fetch menu prices
-        menu_ref = db.collection("menu_prices").get()
-        menu_prices = {item.id.strip().lower(): item.to_dict().get("price") for item in menu_ref}
-
-        total_amount = current_order.get("totalAmount", 0)
-        updated_items = current_order.get("orderItems", [])
-
-        for i, item in enumerate(new_items):
-            name = item.strip().lower()
-            quantity = int(quantities[i]) if i < len(quantities) and quantities[i].isdigit() else 1
-            price = menu_prices.get(name)
-
-            if not price:
-                return jsonify({"fulfillmentText": f"Item '{item}' is not available in the menu."})
-
-            # Check if the item already exists in the current order
-            existing_item = next((order_item for order_item in updated_items if order_item["item"].strip().lower() == name), None)
-
-            if existing_item:
-                # If item exists, update the quantity
-                existing_item["quantity"] += quantity
-            else:
-                # If item is new, add to the list
-                updated_items.append({"item": item, "quantity": quantity})
-
-            total_amount += price * quantity
-
-        order_ref.set({"orderItems": updated_items, "totalAmount": total_amount}, merge=True)
-        return jsonify({"fulfillmentText": f"Added items to your order. Updated total: ₹{total_amount}."})
-
+        menu_prices = menu_cache.prices()
+
+        # Validate everything against the menu first so the order needs no read
+        added, added_amount = fulfillment.price_items(req.menu_items, req.quantities, menu_prices, lenient_quantities=True)
+
+        # One atomic write: increment each line quantity and the total
+        increments, names = fulfillment.add_increments(added, added_amount)
+        try:
+            results = store.commit_writes([("increment", order_id, increments, names)] + sales.added(added, added_amount))
+        except WriteOutcomeUnknown:
+            return fulfillment.CHANGE_SAVING_REPLY
+        except StoreUnavailable:
+            # The order's total is unknown without the store; quote the items
+            return fulfillment.ITEMS_QUOTED_REPLY(amount=added_amount)
+        total_amount = results[0][TOTAL_AMOUNT]
+
+        return fulfillment.ITEMS_ADDED_REPLY(total_amount=total_amount)
+
+    except OrderRejected as rejected:
+        return Reply(str(rejected))
+    except OrderNotFound:
+        return fulfillment.ORDER_NOT_FOUND_REPLY
     except ValueError as ve:
-        logging.error(f"Value error while adding items to order: {ve}")
-        return jsonify({"fulfillmentText": "Invalid quantity provided. Please check your input and try again."})
+        logging.error("Value error while adding items to order: %s", ve)
+        return fulfillment.INVALID_QUANTITY_REPLY
     except Exception as e:
-        logging.error(f"Error adding items to order: {e}")
-        return jsonify({"fulfillmentText": "Failed to add items to your order. Please try again later."})
+        logging.error("Error adding items to order: %s", e)
+        return fulfillment.ADD_FAILED_REPLY
 
+@router.intent(REMOVE_FROM_ORDER_INTENT, *ORDER_MIDDLEWARE)
 def handle_remove_from_order(req):
+    order_id = req.order_id
     try:
-        logging.info("Request received: %s", req)
-
-        # Extract parameters
-        data = req.get('queryResult', {}).get('parameters', {})
-        items_to_remove = data.get("menu_item", [])
-        quantities = data.get("quantity", [])
-        order_id = data.get("order_id", "")
-
-        logging.info("Parsed parameters: items_to_remove=%s, quantities=%s, order_id=%s", items_to_remove, quantities, order_id)
-
-        # Flatten nested lists if necessary
-        if isinstance(items_to_remove, list) and any(isinstance(i, list) for i in items_to_remove):
-            items_to_remove = [item for sublist in items_to_remove for item in sublist]
-        if isinstance(quantities, list) and any(isinstance(q, list) for q in quantities):
-            quantities = [q for sublist in quantities for q in sublist]
-
-        logging.info("Validated parameters: items_to_remove=%s, quantities=%s", items_to_remove, quantities)
+        logging.debug("Parsed parameters: items_to_remove=%s, quantities=%s, order_id=%s", req.menu_items, req.quantities, order_id)
 
         if not order_id:
-            return jsonify({"fulfillmentText": "Order ID is missing. Please provide a valid order ID."})
-
-        # Fetch existing order
-        order_ref = db.collection("orders").document(order_id)
-        order = order_ref.get()
-
-        if not order.exists:
-            logging.error("Order not found for ID: %s", order_id)
-            return jsonify({"fulfillmentText": f"No order found with ID {order_id}."})
+            return fulfillment.REMOVE_MISSING_ORDER_ID_REPLY
 
-        current_order = order.to_dict()
-        updated_items = current_order.get("orderItems", [])
-        total_amount = current_order.get("totalAmount", 0)
+        order_id = normalize_order_id(order_id)
 
-        logging.info("Fetched order: %s", current_order)
+        quantities = fulfillment.remove_quantities(req.menu_items, req.quantities)
 
         # Fetch menu prices for reference
-        menu_ref = db.collection("menu_prices").get()
-        menu_prices = {item.id.strip().lower(): item.to_dict().get("price") for item in menu_ref}
-
-        logging.info("Fetched menu prices: %s", menu_prices)
-
-        # Remove items from the order
-        for i, item in enumerate(items_to_remove):
-            name = str(item).strip().lower()  # Ensure the item is a string
-            quantity_to_remove = int(quantities[i]) if i < len(quantities) else 1
-
-            logging.info("Attempting to remove item: %s, quantity: %d", name, quantity_to_remove)
+        menu_prices = menu_cache.prices()
 
-            item_found = False
-            for order_item in updated_items:
-                if order_item["item"].strip().lower() == name:
-                    item_found = True
-                    if order_item["quantity"] >= quantity_to_remove:
-                        order_item["quantity"] -= quantity_to_remove
-                        total_amount -= menu_prices.get(name, 0) * quantity_to_remove
-                        if order_item["quantity"] == 0:
-                            updated_items.remove(order_item)
-                        break
-                    else:
-                        logging.warning("Not enough quantity for item: %s", name)
-                        return jsonify({
-                            "fulfillmentText": f"Cannot remove {quantity_to_remove} {item}(s). You only have {order_item['quantity']} in the order."
-                        })
-
-            if not item_found:
-                logging.warning("Item not found in order: %s", name)
-                return jsonify({"fulfillmentText": f"Item '{item}' is not in your order."})
-
-        logging.info("Updated items: %s, total_amount: %s", updated_items, total_amount)
-
-        # Update the Firestore document
-        order_ref.set({"orderItems": updated_items, "totalAmount": total_amount}, merge=True)
+        # Read, check and update the order atomically; the mutation may be
+        # re-run on contention
+        fields = store.mutate_order(
+            order_id,
+            lambda current_order: fulfillment.remove_items(current_order, req.menu_items, quantities, menu_prices),
+            writes=sales.changed,
+        )
 
         # Respond with success
-        return jsonify({
-            "fulfillmentText": f"Items removed successfully! Updated total amount: ₹{total_amount}."
-        })
+        return fulfillment.ITEMS_REMOVED_REPLY(total_amount=fields["totalAmount"])
+
+    except OrderNotFound:
+        logging.error("Order not found for ID: %s", order_id)
+        return fulfillment.ORDER_ID_NOT_FOUND_REPLY(order_id=order_id)
+    except OrderRejected as rejected:
+        return Reply(str(rejected))
+    except StoreUnavailable:
+        return fulfillment.ORDER_UNAVAILABLE_REPLY
+    except ValueError as ve:
+        logging.error("Value error while removing items from order: %s", ve)
+        return fulfillment.INVALID_QUANTITY_REPLY
 
     except Exception as e:
         logging.error("Error removing items from order: %s", e)
-        return jsonify({"fulfillmentText": "Failed to remove items from your order. Please try again later."})
+        return fulfillment.REMOVE_FAILED_REPLY
 
 
+metrics.register_router(router)
+
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port, debug=True)
-
+    # Development server only; production runs gunicorn (see Procfile.txt)
+    app.run(host="0.0.0.0", port=port, debug=os.environ.get("FLASK_DEBUG") == "1")
 
 
 """import os
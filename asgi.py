@@ -0,0 +1,335 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import date
+from urllib.parse import parse_qs
+import deadlines
+import dialogflow
+import fulfillment
+import metrics
+from circuit_breaker import CircuitBreaker, GuardedAsyncStore, StoreUnavailable
+from dialogflow import Reply, WebhookRequest
+from idempotency import ResponseCache
+from intent_router import AsyncIntentRouter
+from fulfillment import ADD_TO_ORDER_INTENT, PLACE_ORDER_INTENT, REMOVE_FROM_ORDER_INTENT, TOTAL_AMOUNT
+from log_config import configure_logging, payload_sampler
+from menu_cache import MenuCache
+from order_cache import order_cache
+from order_export import ExportQuery, export_chunks
+from order_ids import new_order_id, normalize_order_id
+from sales_counters import SalesCounters
+from storage import OrderExists, OrderNotFound, OrderRejected, create_async_store
+from write_behind import AsyncGroupCommitStore, DeferredWrites, WriteOutcomeUnknown
+
+# ASGI version of the webhook in app.py: same route, same intents, same
+# replies, but every store call is awaited so one worker can serve many
+# requests that are waiting on Firestore. Run with e.g.
+#   uvicorn asgi:app --port 10000
+
+configure_logging()
+
+store = metrics.InstrumentedAsyncStore(create_async_store())
+if os.environ.get("WRITE_BEHIND") == "1":
+    store = AsyncGroupCommitStore(store)
+    metrics.register_write_behind(store)
+breaker = CircuitBreaker()
+store = GuardedAsyncStore(store, breaker)
+metrics.register_breaker(breaker)
+# Saved from a background thread, through the synchronous store
+deferred = DeferredWrites(store.menu_store)
+metrics.register_deferred_writes(deferred)
+menu_cache = MenuCache(store.menu_store)
+metrics.register_menu_cache(menu_cache)
+response_cache = ResponseCache(store)
+metrics.register_response_cache(response_cache)
+metrics.register_order_cache(order_cache)
+sales = SalesCounters()
+
+
+async def unknown_intent(req):
+    return fulfillment.UNKNOWN_INTENT_REPLY
+
+
+router = AsyncIntentRouter(unknown_intent, fulfillment.BUSY_REPLY)
+ORDER_MIDDLEWARE = (response_cache.async_middleware, metrics.time_handler_async)
+
+
+async def get_menu_prices():
+    prices = menu_cache.peek()
+    if prices is None:
+        prices = await asyncio.to_thread(menu_cache.prices)
+    return prices
+
+
+async def warm_up():
+    try:
+        await asyncio.gather(asyncio.to_thread(menu_cache.prices), store.warm_up())
+    except Exception as e:
+        logging.warning("Warm-up failed: %s", e)
+
+
+async def webhook(payload):
+    start = time.perf_counter()
+    intent = None
+    try:
+        req = WebhookRequest.from_payload(payload)
+        intent = req.intent
+        if payload_sampler.sample(intent):
+            logging.info("Request received", extra={"intent": intent, "payload": payload})
+
+        with deadlines.request_deadline():
+            reply = await router.dispatch(req)
+
+    except Exception as e:
+        logging.error("Error handling request: %s", e)
+        reply = fulfillment.INTERNAL_ERROR_REPLY
+
+    metrics.observe_webhook(intent, reply, time.perf_counter() - start)
+    return reply
+
+
+@router.intent(PLACE_ORDER_INTENT, *ORDER_MIDDLEWARE)
+async def handle_place_order(req):
+    try:
+        if not req.menu_items:
+            return fulfillment.NO_ITEMS_REPLY
+
+        menu_prices = await get_menu_prices()
+        order_items, total_amount = fulfillment.price_items(req.menu_items, req.quantities, menu_prices)
+
+        order_id = new_order_id()
+        new_order = fulfillment.new_order(order_id, order_items, total_amount)
+
+        writes = [("create", order_id, new_order)] + sales.placed(order_items, total_amount)
+        try:
+            try:
+                await store.commit_writes(writes)
+            except OrderExists:
+                # Another instance drew the same random host for its IDs
+                # (see order_ids.py); the next ID from ours won't clash
+                logging.warning("Order ID already taken, retrying with a new one", extra={"order_id": order_id})
+                order_id = new_order_id()
+                new_order = fulfillment.new_order(order_id, order_items, total_amount)
+                writes = [("create", order_id, new_order)] + sales.placed(order_items, total_amount)
+                await store.commit_writes(writes)
+        except WriteOutcomeUnknown:
+            logging.warning("Order write outcome unknown", extra={"order_id": order_id, "total_amount": total_amount})
+            return fulfillment.ORDER_SAVING_REPLY(order_id=order_id, total_amount=total_amount)
+        except StoreUnavailable:
+            if not deferred.submit(writes):
+                raise
+            logging.warning("Order deferred", extra={"order_id": order_id, "total_amount": total_amount})
+            return fulfillment.ORDER_RECEIVED_REPLY(order_id=order_id, total_amount=total_amount)
+        logging.info("Order placed successfully", extra={"order_id": order_id, "total_amount": total_amount})
+
+        return fulfillment.ORDER_PLACED_REPLY(order_id=order_id, total_amount=total_amount)
+    except OrderRejected as rejected:
+        return Reply(str(rejected))
+    except Exception as e:
+        logging.error("Error placing order: %s", e)
+        return fulfillment.PLACE_FAILED_REPLY
+
+
+@router.intent(ADD_TO_ORDER_INTENT, *ORDER_MIDDLEWARE)
+async def handle_add_to_order(req):
+    try:
+        if not req.order_id:
+            return fulfillment.ADD_MISSING_ORDER_ID_REPLY
+
+        order_id = normalize_order_id(req.order_id)
+
+        # The menu check has to pass before the single increment write
+        menu_prices = await get_menu_prices()
+        added, added_amount = fulfillment.price_items(req.menu_items, req.quantities, menu_prices, lenient_quantities=True)
+
+        increments, names = fulfillment.add_increments(added, added_amount)
+        try:
+            results = await store.commit_writes([("increment", order_id, increments, names)] + sales.added(added, added_amount))
+        except WriteOutcomeUnknown:
+            return fulfillment.CHANGE_SAVING_REPLY
+        except StoreUnavailable:
+            return fulfillment.ITEMS_QUOTED_REPLY(amount=added_amount)
+        total_amount = results[0][TOTAL_AMOUNT]
+
+        return fulfillment.ITEMS_ADDED_REPLY(total_amount=total_amount)
+
+    except OrderRejected as rejected:
+        return Reply(str(rejected))
+    except OrderNotFound:
+        return fulfillment.ORDER_NOT_FOUND_REPLY
+    except ValueError as ve:
+        logging.error("Value error while adding items to order: %s", ve)
+        return fulfillment.INVALID_QUANTITY_REPLY
+    except Exception as e:
+        logging.error("Error adding items to order: %s", e)
+        return fulfillment.ADD_FAILED_REPLY
+
+
+@router.intent(REMOVE_FROM_ORDER_INTENT, *ORDER_MIDDLEWARE)
+async def handle_remove_from_order(req):
+    order_id = req.order_id
+    try:
+        logging.debug("Parsed parameters: items_to_remove=%s, quantities=%s, order_id=%s", req.menu_items, req.quantities, order_id)
+
+        if not order_id:
+            return fulfillment.REMOVE_MISSING_ORDER_ID_REPLY
+
+        order_id = normalize_order_id(order_id)
+        quantities = fulfillment.remove_quantities(req.menu_items, req.quantities)
+
+        # The menu is loaded concurrently with the transactional order read
+        fields = await store.mutate_order(
+            order_id,
+            lambda current_order, menu_prices: fulfillment.remove_items(current_order, req.menu_items, quantities, menu_prices),
+            prefetch=get_menu_prices,
+            writes=sales.changed,
+        )
+
+        return fulfillment.ITEMS_REMOVED_REPLY(total_amount=fields["totalAmount"])
+
+    except OrderNotFound:
+        logging.error("Order not found for ID: %s", order_id)
+        return fulfillment.ORDER_ID_NOT_FOUND_REPLY(order_id=order_id)
+    except OrderRejected as rejected:
+        return Reply(str(rejected))
+    except StoreUnavailable:
+        return fulfillment.ORDER_UNAVAILABLE_REPLY
+    except ValueError as ve:
+        logging.error("Value error while removing items from order: %s", ve)
+        return fulfillment.INVALID_QUANTITY_REPLY
+    except Exception as e:
+        logging.error("Error removing items from order: %s", e)
+        return fulfillment.REMOVE_FAILED_REPLY
+
+
+metrics.register_router(router)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/metrics":
+        if scope["method"] != "GET":
+            await send_json(send, 405, {"error": "Method Not Allowed"})
+            return
+        await send_body(send, 200, metrics.registry.render().encode(), metrics.CONTENT_TYPE.encode())
+        return
+    if scope["path"] == "/sales":
+        if scope["method"] != "GET":
+            await send_json(send, 405, {"error": "Method Not Allowed"})
+            return
+        await send_sales(send, parse_qs(scope.get("query_string", b"").decode()))
+        return
+    if scope["path"] == "/orders":
+        if scope["method"] != "GET":
+            await send_json(send, 405, {"error": "Method Not Allowed"})
+            return
+        await send_orders(send, parse_qs(scope.get("query_string", b"").decode()))
+        return
+    if scope["path"] != "/":
+        await send_json(send, 404, {"error": "Not Found"})
+        return
+    if scope["method"] != "POST":
+        await send_json(send, 405, {"error": "Method Not Allowed"})
+        return
+
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+    try:
+        payload = dialogflow.loads(body)
+    except ValueError:
+        await send_json(send, 400, {"error": "Bad Request"})
+        return
+
+    reply = await webhook(payload)
+    await send_body(send, 200, dialogflow.encode_reply(reply), b"application/json")
+
+
+async def lifespan(receive, send):
+    warm_up_task = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Connect and load the menu in the background, inside this
+            # worker's event loop, so startup isn't held up
+            warm_up_task = asyncio.create_task(warm_up())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if warm_up_task is not None:
+                warm_up_task.cancel()
+            menu_cache.close()
+            await asyncio.to_thread(deferred.close)
+            await store.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def send_sales(send, query):
+    # Today's totals, or those of ?day=YYYY-MM-DD; counters are read
+    # through the synchronous store, off the event loop
+    try:
+        day = date.fromisoformat(query["day"][0]) if "day" in query else None
+    except ValueError:
+        await send_json(send, 400, {"error": "day must be YYYY-MM-DD"})
+        return
+    try:
+        totals = await asyncio.to_thread(sales.totals, store.menu_store, day)
+    except StoreUnavailable:
+        await send_json(send, 503, {"error": "store unavailable"})
+        return
+    await send_json(send, 200, totals)
+
+
+async def send_orders(send, query):
+    # Order history as NDJSON or CSV, see order_export.py; each page is read
+    # through the synchronous store, off the event loop, and sent before the
+    # next one is read
+    try:
+        query = ExportQuery.from_args({name: values[0] for name, values in query.items()})
+    except ValueError as e:
+        await send_json(send, 400, {"error": str(e)})
+        return
+    chunks = export_chunks(store.menu_store, query)
+    try:
+        chunk = await asyncio.to_thread(next, chunks)
+    except StoreUnavailable:
+        await send_json(send, 503, {"error": "store unavailable"})
+        return
+    except Exception:
+        await send_json(send, 500, {"error": "export failed"})
+        return
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", query.content_type.encode()),
+            (b"content-disposition", f'attachment; filename="{query.filename}"'.encode()),
+        ],
+    })
+    while chunk is not None:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        chunk = await asyncio.to_thread(next, chunks, None)
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send_json(send, status, payload):
+    await send_body(send, status, dialogflow.dumps(payload), b"application/json")
+
+
+async def send_body(send, status, body, content_type):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
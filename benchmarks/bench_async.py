@@ -0,0 +1,124 @@
+"""Side-by-side throughput of the sync Flask webhook and the ASGI webhook.
+
+Both run in-process against the same in-memory store, wrapped so every
+store call waits ``--latency-ms`` the way a Firestore round trip would.
+The sync path gets ``--threads`` worker threads (the gunicorn thread
+count); the async path runs up to ``--concurrency`` requests at once on a
+single event loop.
+
+    python benchmarks/bench_async.py --requests 2000 --latency-ms 20
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["ORDER_STORE"] = "memory"
+
+import app as sync_app  # noqa: E402
+import asgi as async_app  # noqa: E402
+from fake_store import AsyncLatencyStore, LatencyStore  # noqa: E402
+from fulfillment import ADD_TO_ORDER_INTENT, PLACE_ORDER_INTENT, REMOVE_FROM_ORDER_INTENT  # noqa: E402
+from initialize_menu import MENU_PRICES  # noqa: E402
+from storage import MemoryStore  # noqa: E402
+
+
+def build_requests(count, orders):
+    intents = (PLACE_ORDER_INTENT, ADD_TO_ORDER_INTENT, REMOVE_FROM_ORDER_INTENT)
+    requests = []
+    for i in range(count):
+        intent = intents[i % 3]
+        parameters = {"menu_item": ["Pizza"], "quantity": ["1"]}
+        if intent != PLACE_ORDER_INTENT:
+            parameters["order_id"] = orders[i % len(orders)]
+        requests.append({"queryResult": {"intent": {"displayName": intent}, "parameters": parameters}})
+    return requests
+
+
+def seed_orders(store, count):
+    orders = []
+    for i in range(count):
+        order_id = f"order_bench_{i}"
+        store.set_order(order_id, {
+            "orderId": order_id,
+            "items": {"pizza": {"item": "Pizza", "quantity": 1000}},
+            "totalAmount": 400000,
+        })
+        orders.append(order_id)
+    return orders
+
+
+def run_sync(requests, threads):
+    local = threading.local()
+
+    def call(req):
+        if not hasattr(local, "client"):
+            local.client = sync_app.app.test_client()
+        return local.client.post("/", json=req).get_json()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(call, requests))
+    return time.perf_counter() - start
+
+
+async def call_asgi(req):
+    body = json.dumps(req).encode()
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": []}
+    await async_app.app(scope, receive, send)
+    return json.loads(sent[-1]["body"])
+
+
+async def run_async(requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(req):
+        async with semaphore:
+            return await call_asgi(req)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(call(req) for req in requests))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1500)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--threads", type=int, default=8, help="sync worker threads")
+    parser.add_argument("--concurrency", type=int, default=200, help="in-flight async requests")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    latency = args.latency_ms / 1000
+
+    memory = MemoryStore(menu=MENU_PRICES)
+    requests = build_requests(args.requests, seed_orders(memory, 50))
+    sync_app.store = LatencyStore(memory, latency)
+    async_app.store = AsyncLatencyStore(memory, latency)
+
+    sync_elapsed = run_sync(requests, args.threads)
+    async_elapsed = asyncio.run(run_async(requests, args.concurrency))
+
+    print(f"requests={args.requests} store latency={args.latency_ms:g}ms")
+    print(f"sync  (flask, {args.threads} threads): {sync_elapsed:.2f}s  {args.requests / sync_elapsed:.0f} req/s")
+    print(f"async (asgi, {args.concurrency} in flight): {async_elapsed:.2f}s  {args.requests / async_elapsed:.0f} req/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Hammer a single order ID with concurrent add intents.
+
+Every thread adds one Pizza per request to the same order through the
+webhook, so after the run the order must hold exactly threads * requests
+extra pizzas. ``--mode rmw`` replays the old get/update path directly on the
+store to show the updates it loses.
+
+    ORDER_STORE=sqlite python benchmarks/bench_contention.py --threads 32
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("ORDER_STORE", "memory")
+
+import app as webhook_app  # noqa: E402
+from order_model import OrderItems  # noqa: E402
+
+ORDER_ID = "order_contention_bench"
+ADD_INTENT = "order.add - context: ongoing-order"
+
+
+def add_request(order_id):
+    return {
+        "queryResult": {
+            "intent": {"displayName": ADD_INTENT},
+            "parameters": {"menu_item": ["Pizza"], "quantity": ["1"], "order_id": order_id},
+        }
+    }
+
+
+def run_webhook(requests_per_thread, barrier):
+    client = webhook_app.app.test_client()
+    body = add_request(ORDER_ID)
+    barrier.wait()
+    for _ in range(requests_per_thread):
+        client.post("/", json=body)
+
+
+def run_read_modify_write(requests_per_thread, barrier):
+    store = webhook_app.store
+    barrier.wait()
+    for _ in range(requests_per_thread):
+        order = store.get_order(ORDER_ID)
+        order_items = OrderItems.from_order(order)
+        order_items.add("Pizza", 1)
+        store.update_order(ORDER_ID, {"items": order_items.to_firestore(), "totalAmount": order["totalAmount"] + 400})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="requests per thread")
+    parser.add_argument("--mode", choices=("webhook", "rmw"), default="webhook")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    store = webhook_app.store
+    store.set_order(ORDER_ID, {
+        "orderId": ORDER_ID,
+        "items": {"pizza": {"item": "Pizza", "quantity": 1}},
+        "totalAmount": 400,
+    })
+
+    worker = run_webhook if args.mode == "webhook" else run_read_modify_write
+    barrier = threading.Barrier(args.threads + 1)
+    threads = [threading.Thread(target=worker, args=(args.requests, barrier)) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = args.threads * args.requests
+    order = store.get_order(ORDER_ID)
+    quantity = OrderItems.from_order(order).get("Pizza").quantity
+    lost = total + 1 - quantity
+
+    print(f"store={type(store).__name__} mode={args.mode} threads={args.threads} requests={total}")
+    print(f"elapsed={elapsed:.3f}s throughput={total / elapsed:.0f} req/s")
+    print(f"final quantity={quantity} expected={total + 1} lost updates={lost}")
+    print(f"final total=₹{order['totalAmount']} expected=₹{(total + 1) * 400}")
+    return 1 if lost else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
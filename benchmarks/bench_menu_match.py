@@ -0,0 +1,167 @@
+"""Menu matching on a large synthetic menu.
+
+Builds a menu of --items names (flavour x dish x style), then times
+MenuMatcher lookups for exact names, plurals and one-typo names against a
+linear difflib scan over the whole menu. Lookups are timed uncached.
+
+First checks names on the default menu that must not be matched to a
+different item: those are at most suggested back to the customer. Exits 1
+if any case gives the wrong answer; --cases-only stops after the check
+(CI runs it that way).
+
+    python benchmarks/bench_menu_match.py --items 20000 --queries 2000
+"""
+import os
+import sys
+import time
+import random
+import difflib
+import argparse
+import itertools
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from initialize_menu import MENU_PRICES  # noqa: E402
+from menu_matcher import MenuMatcher, normalize_item_name  # noqa: E402
+
+# (what the customer said, match(), suggest()) on the default menu
+CASES = [
+    ("pizzas", "pizza", "pizza"),
+    ("chili paneer", "chilli paneer", "chilli paneer"),
+    ("choclate shake", "chocolate shake", "chocolate shake"),
+    ("garlicbread", "garlic bread", "garlic bread"),
+    ("masala dosa", None, None),
+    ("chicken biryani", None, None),
+    ("cheese pizza", None, None),
+    ("paneer pizza", None, None),
+    ("veg burger", None, None),
+    ("shake", None, None),
+    ("bread", None, "garlic bread"),
+    ("lime soda", None, "fresh lime soda"),
+]
+
+FLAVOURS = [
+    "masala", "paneer", "chicken", "mutton", "veg", "egg", "cheese", "butter", "garlic", "schezwan",
+    "tandoori", "peri peri", "mushroom", "corn", "aloo", "gobi", "palak", "chole", "rajma", "kadai",
+    "malai", "achari", "hariyali", "mint", "mango", "strawberry", "chocolate", "vanilla", "oreo",
+    "caramel", "coffee", "kesar", "pista", "badam", "rose", "lemon", "ginger", "honey", "chilli", "pepper",
+]
+DISHES = [
+    "pizza", "burger", "wrap", "sandwich", "roll", "dosa", "uttapam", "paratha", "biryani", "pulao",
+    "noodles", "pasta", "momos", "fries", "nachos", "tikka", "kebab", "curry", "soup", "salad",
+    "shake", "lassi", "soda", "mojito", "sundae", "kulfi", "cake", "pastry", "samosa", "pakoda",
+]
+STYLES = ["", "jumbo", "mini", "special", "classic", "double", "family", "spicy", "grilled", "crispy",
+          "loaded", "healthy", "royal", "street style", "combo", "platter", "bowl", "deluxe"]
+
+
+def build_menu(count):
+    names = []
+    for flavour, dish, style in itertools.product(FLAVOURS, DISHES, STYLES):
+        names.append(" ".join(part for part in (style, flavour, dish) if part))
+        if len(names) == count:
+            break
+    return names
+
+
+def plural(name):
+    if name.endswith("s"):
+        return name
+    if name.endswith("y") and name[-2:-1] not in "aeiou":
+        return name[:-1] + "ies"
+    if name.endswith(("sh", "ch", "x", "z")):
+        return name + "es"
+    return name + "s"
+
+
+def typo(name, rng):
+    i = rng.randrange(len(name))
+    kind = rng.choice(("drop", "swap", "double"))
+    if kind == "drop" and len(name) > 4:
+        return name[:i] + name[i + 1:]
+    if kind == "swap" and i < len(name) - 1:
+        return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+    return name[:i] + name[i] + name[i:]
+
+
+def queries(names, count, rng):
+    result = []
+    for _ in range(count):
+        name = rng.choice(names)
+        kind = rng.choice(("exact", "plural", "typo"))
+        if kind == "exact":
+            result.append((kind, name, name))
+        elif kind == "plural":
+            result.append((kind, plural(name), name))
+        else:
+            result.append((kind, typo(name, rng), name))
+    return result
+
+
+def time_lookups(lookup, cases):
+    timings = {}
+    correct = {}
+    for kind, query, expected in cases:
+        start = time.perf_counter()
+        found = lookup(query)
+        timings.setdefault(kind, []).append(time.perf_counter() - start)
+        correct[kind] = correct.get(kind, 0) + (found == expected)
+    return timings, correct
+
+
+def check_cases():
+    matcher = MenuMatcher([normalize_item_name(name) for name in MENU_PRICES])
+    wrong = 0
+    for query, match, suggestion in CASES:
+        found = (matcher.match(query), matcher.suggest(query))
+        if found != (match, suggestion):
+            wrong += 1
+            print(f"  {query!r}: match {found[0]!r}, suggest {found[1]!r}; expected {match!r}, {suggestion!r}")
+    print(f"default menu: {len(CASES) - wrong}/{len(CASES)} cases right")
+    return wrong == 0
+
+
+def report(label, timings, correct):
+    print(label)
+    for kind, samples in sorted(timings.items()):
+        samples.sort()
+        p50 = statistics.median(samples) * 1e6
+        p99 = samples[int(len(samples) * 0.99) - 1] * 1e6
+        print(f"  {kind:6} {len(samples):5} lookups  p50 {p50:8.1f} us  p99 {p99:8.1f} us  correct {correct[kind] / len(samples):.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--scan-queries", type=int, default=100, help="lookups for the difflib baseline")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cases-only", action="store_true", help="only check the default menu cases")
+    args = parser.parse_args()
+
+    ok = check_cases()
+    if args.cases_only:
+        sys.exit(0 if ok else 1)
+
+    rng = random.Random(args.seed)
+    names = build_menu(args.items)
+    start = time.perf_counter()
+    matcher = MenuMatcher(names)
+    print(f"menu {len(names)} items, index built in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    cases = queries(names, args.queries, rng)
+    # _match skips the lookup cache
+    report("MenuMatcher", *time_lookups(matcher._match, cases))
+
+    def scan(query):
+        found = difflib.get_close_matches(query, names, n=1, cutoff=0.6)
+        return found[0] if found else None
+
+    report("difflib scan", *time_lookups(scan, cases[:args.scan_queries]))
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Per-request CPU spent decoding webhook calls and encoding replies.
+
+Replays the bodies in traffic.jsonl through the old path (Flask's JSON
+loader as used by request.get_json, nested .get() lookups, ad-hoc
+flattening and int() quantities, an f-string reply through jsonify) and the
+new one (dialogflow.WebhookRequest and a reply template). Reading the body
+off the socket is the same for both and left out. The best of --repeats
+runs is reported.
+
+    python benchmarks/bench_parse.py --rounds 2000
+"""
+import os
+import sys
+import time
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("ORDER_STORE", "memory")
+
+import dialogflow  # noqa: E402
+import fulfillment  # noqa: E402
+from app import app  # noqa: E402
+from dialogflow import WebhookRequest  # noqa: E402
+from flask import Response, jsonify  # noqa: E402
+
+TRAFFIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traffic.jsonl")
+
+
+def before(body):
+    # webhook() and the handlers' parameter handling as they were
+    req = app.json.loads(body)
+    intent = req.get('queryResult', {}).get('intent', {}).get('displayName', "")
+    if not intent:
+        raise ValueError("Intent not found in the request.")
+    data = req.get('queryResult', {}).get('parameters', {})
+    items = data.get("menu_item", [])
+    quantities = data.get("quantity", [])
+    if isinstance(items, list) and any(isinstance(value, list) for value in items):
+        items = [value for sublist in items for value in sublist]
+    if isinstance(quantities, list) and any(isinstance(value, list) for value in quantities):
+        quantities = [value for sublist in quantities for value in sublist]
+    total = sum(int(quantities[i]) if i < len(quantities) else 1 for i in range(len(items)))
+    text = f"Added items to your order. Updated total: ₹{total * 100}."
+    return jsonify({"fulfillmentText": text})
+
+
+def after(body):
+    # As webhook(): the payload is kept for sampled request logging
+    req = WebhookRequest.from_payload(dialogflow.loads(body))
+    total = sum(fulfillment.quantity_at(req.quantities, i) for i in range(len(req.menu_items)))
+    reply = fulfillment.ITEMS_ADDED_REPLY(total_amount=total * 100)
+    return Response(dialogflow.encode_reply(reply), content_type="application/json")
+
+
+def measure(path, bodies, rounds, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.process_time()
+        for _ in range(rounds):
+            for body in bodies:
+                path(body)
+        best = min(best, time.process_time() - start)
+    return best / (rounds * len(bodies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200, help="passes over traffic.jsonl per run")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(TRAFFIC, encoding="utf-8") as f:
+        bodies = [json.dumps(json.loads(line)).encode() for line in f if line.strip()]
+
+    with app.app_context():
+        # Both paths must give the same reply
+        assert json.loads(before(bodies[0]).get_data()) == json.loads(after(bodies[0]).get_data())
+        old = measure(before, bodies, args.rounds, args.repeats)
+        new = measure(after, bodies, args.rounds, args.repeats)
+    print(f"json: {'orjson' if dialogflow.orjson is not None else 'json module'}, {len(bodies)} bodies x {args.rounds}")
+    print(f"before (get_json/jsonify): {old * 1e6:6.1f} us/request")
+    print(f"after (WebhookRequest):    {new * 1e6:6.1f} us/request  ({old / new:.1f}x less CPU)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Measure cold-start cost of the webhook process.
+
+Reports, each in a fresh interpreter: the time the old app.py spent at
+import (flask + firebase_admin imports, credentials and Firestore client;
+no RPC is made), the import time of app.py as it is now, and the time for that fresh process to answer
+its first webhook (memory store, so no network).
+
+    python benchmarks/bench_startup.py --runs 5
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EAGER_IMPORTS = """
+import time
+start = time.perf_counter()
+import flask, firebase_admin
+from firebase_admin import credentials, firestore
+firebase_admin.initialize_app(credentials.Certificate("servicekey.json"))
+firestore.client()
+print(time.perf_counter() - start)
+"""
+
+APP_IMPORT = """
+import time
+start = time.perf_counter()
+import app
+print(time.perf_counter() - start)
+"""
+
+FIRST_REQUEST = """
+import time
+start = time.perf_counter()
+import app
+body = {"queryResult": {"intent": {"displayName": "order_item_place"},
+        "parameters": {"menu_item": ["Pizza"], "quantity": ["1"]}}}
+app.app.test_client().post("/", json=body)
+print(time.perf_counter() - start)
+"""
+
+
+def measure(code, runs, env):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    print(f"eager firebase init (old app.py):    {measure(EAGER_IMPORTS, args.runs, env) * 1000:.0f} ms")
+    env["ORDER_STORE"] = "firestore"
+    print(f"import app (lazy firestore):         {measure(APP_IMPORT, args.runs, env) * 1000:.0f} ms")
+    env["ORDER_STORE"] = "memory"
+    print(f"import + first webhook (memory):     {measure(FIRST_REQUEST, args.runs, env) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Latency-injecting store wrappers for benchmarks.
+
+Both wrap a real (usually in-memory) store, sleep ``latency`` seconds per
+call the way a Firestore round trip would, and count calls per intent and
+method. The harness sets ``current_intent`` before dispatching a request.
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import contextvars
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import AsyncStoreWrapper, StoreWrapper  # noqa: E402
+
+current_intent = contextvars.ContextVar("current_intent", default="")
+
+
+class CallCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def record(self, method):
+        with self._lock:
+            self.calls[(current_intent.get(), method)] += 1
+
+    def by_intent(self):
+        result = {}
+        for (intent, method), count in sorted(self.calls.items()):
+            result.setdefault(intent, {})[method] = count
+        return result
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+
+class LatencyStore(StoreWrapper):
+    def __init__(self, store, latency, counter=None):
+        super().__init__(store)
+        self._latency = latency
+        self.counter = counter or CallCounter()
+
+    def _call(self, operation, *args, **kwargs):
+        self.counter.record(operation)
+        if self._latency:
+            time.sleep(self._latency)
+        return getattr(self._store, operation)(*args, **kwargs)
+
+
+class AsyncLatencyStore(AsyncStoreWrapper):
+    # Serves a synchronous store, as SyncStoreAdapter does inline
+
+    def __init__(self, store, latency, counter=None):
+        super().__init__(store)
+        self._latency = latency
+        self.counter = counter or CallCounter()
+        # MenuCache loads through a sync store; count those calls too
+        self.menu_store = LatencyStore(store, latency, self.counter)
+
+    async def _wait(self, method):
+        self.counter.record(method)
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+    async def _call(self, operation, *args, **kwargs):
+        await self._wait(operation)
+        return getattr(self._store, operation)(*args, **kwargs)
+
+    async def mutate_order(self, order_id, mutate, prefetch=None, writes=None):
+        if prefetch is None:
+            return await self._call("mutate_order", order_id, mutate, writes)
+        _, prefetched = await asyncio.gather(self._wait("mutate_order"), prefetch())
+        return self._store.mutate_order(order_id, lambda order: mutate(order, prefetched), writes)
+
+    async def warm_up(self):
+        pass
+
+    async def close(self):
+        self._store.close()
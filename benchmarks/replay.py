@@ -0,0 +1,297 @@
+"""Replay captured Dialogflow webhook traffic and report latency.
+
+Reads one Dialogflow request body per line (default: benchmarks/traffic.jsonl)
+and replays every session in order, many sessions at once. The order ID
+returned by a session's place-order reply is substituted into that
+session's later add/remove requests, so the captured IDs don't need to
+exist.
+
+Targets:
+  flask           app.py in-process via the Flask test client
+  asgi            asgi.py in-process
+  http://host:port/   a running server (store call counts not available)
+
+In-process targets run against an in-memory store that sleeps
+--latency-ms per call and counts calls per intent; --write-behind puts
+the group-commit pipeline (write_behind.py) in front of it.
+
+    python benchmarks/replay.py --target flask --concurrency 16 --iterations 20
+    python benchmarks/replay.py --json --max-p95-ms 200 --max-store-calls 2   # CI gate
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+import statistics
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+os.environ["ORDER_STORE"] = "memory"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from fake_store import AsyncLatencyStore, LatencyStore, current_intent  # noqa: E402
+from fulfillment import reply_outcome  # noqa: E402
+from initialize_menu import MENU_PRICES  # noqa: E402
+from menu_cache import MenuCache  # noqa: E402
+from storage import MemoryStore  # noqa: E402
+from write_behind import AsyncGroupCommitStore, GroupCommitStore  # noqa: E402
+
+ORDER_ID_PATTERN = re.compile(r"Order ID: (\S+?)\.(?:\s|$)")
+
+
+def load_sessions(path):
+    sessions = {}
+    with open(path, encoding="utf-8") as traffic:
+        for line in traffic:
+            if line.strip():
+                req = json.loads(line)
+                sessions.setdefault(req.get("session", ""), []).append(req)
+    return list(sessions.values())
+
+
+def intent_of(req):
+    return req.get("queryResult", {}).get("intent", {}).get("displayName", "")
+
+
+def prepare(req, order_id, iteration):
+    req = json.loads(json.dumps(req))
+    if "session" in req:
+        req["session"] = f"{req['session']}-{iteration}"
+    if "responseId" in req:
+        req["responseId"] = f"{req['responseId']}-{iteration}"
+    parameters = req.get("queryResult", {}).get("parameters", {})
+    if order_id and parameters.get("order_id"):
+        parameters["order_id"] = order_id
+    return req
+
+
+def record_reply(reply, order_id):
+    match = ORDER_ID_PATTERN.search(reply.get("fulfillmentText", ""))
+    return match.group(1) if match else order_id
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.failures = {}
+
+    def add(self, intent, seconds, reply):
+        # Anything but a success: errors, busy and degraded replies alike
+        failed = reply_outcome(reply.get("fulfillmentText", "")) != "ok"
+        with self._lock:
+            self.latencies.setdefault(intent, []).append(seconds)
+            if failed:
+                self.failures[intent] = self.failures.get(intent, 0) + 1
+
+
+# Targets -------------------------------------------------------------------
+
+def flask_target(latency, counter_holder, write_behind=False):
+    import app
+
+    memory = MemoryStore(menu=MENU_PRICES)
+    app.store = LatencyStore(memory, latency)
+    counter_holder.append(app.store.counter)
+    if write_behind:
+        app.store = GroupCommitStore(app.store)
+    app.menu_cache = MenuCache(app.store)
+    local = threading.local()
+
+    def call(req):
+        if not hasattr(local, "client"):
+            local.client = app.app.test_client()
+        return local.client.post("/", json=req).get_json()
+
+    return call
+
+
+def http_target(url):
+    def call(req):
+        request = urllib.request.Request(
+            url, data=json.dumps(req).encode(), headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read())
+
+    return call
+
+
+async def call_asgi(asgi_app, req):
+    body = json.dumps(req).encode()
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": []}
+    await asgi_app(scope, receive, send)
+    return json.loads(sent[-1]["body"])
+
+
+# Runners -------------------------------------------------------------------
+
+def run_threaded(call, sessions, iterations, concurrency, results):
+    def replay_session(job):
+        session, iteration = job
+        order_id = None
+        for req in session:
+            intent = intent_of(req)
+            current_intent.set(intent)
+            start = time.perf_counter()
+            reply = call(prepare(req, order_id, iteration))
+            results.add(intent, time.perf_counter() - start, reply)
+            order_id = record_reply(reply, order_id)
+
+    jobs = [(session, iteration) for iteration in range(iterations) for session in sessions]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(replay_session, jobs))
+    return time.perf_counter() - start
+
+
+async def run_async(sessions, iterations, concurrency, latency, results, counter_holder, write_behind=False):
+    import asgi
+
+    asgi.store = AsyncLatencyStore(MemoryStore(menu=MENU_PRICES), latency)
+    counter_holder.append(asgi.store.counter)
+    if write_behind:
+        asgi.store = AsyncGroupCommitStore(asgi.store)
+    asgi.menu_cache = MenuCache(asgi.store.menu_store)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def replay_session(session, iteration):
+        async with semaphore:
+            order_id = None
+            for req in session:
+                intent = intent_of(req)
+                current_intent.set(intent)
+                start = time.perf_counter()
+                reply = await call_asgi(asgi.app, prepare(req, order_id, iteration))
+                results.add(intent, time.perf_counter() - start, reply)
+                order_id = record_reply(reply, order_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        replay_session(session, iteration) for iteration in range(iterations) for session in sessions
+    ))
+    return time.perf_counter() - start
+
+
+# Report --------------------------------------------------------------------
+
+def percentile(samples, q):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[q - 1]
+
+
+def summarize(results, elapsed, counter):
+    calls = counter.by_intent() if counter else {}
+    report = {"elapsed_s": elapsed, "intents": {}}
+    everything = []
+    for intent, samples in sorted(results.latencies.items()):
+        everything.extend(samples)
+        entry = {
+            "requests": len(samples),
+            "failures": results.failures.get(intent, 0),
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+        }
+        if counter:
+            entry["store_calls"] = calls.get(intent, {})
+            entry["store_calls_per_request"] = sum(entry["store_calls"].values()) / len(samples)
+        report["intents"][intent] = entry
+    if counter:
+        # Calls made off the request path, e.g. write-behind commits
+        report["background_store_calls"] = calls.get("", {})
+    report["requests"] = len(everything)
+    report["throughput_rps"] = len(everything) / elapsed
+    report["p50_ms"] = percentile(everything, 50) * 1000
+    report["p95_ms"] = percentile(everything, 95) * 1000
+    report["p99_ms"] = percentile(everything, 99) * 1000
+    return report
+
+
+def print_report(report):
+    print(f"{report['requests']} requests in {report['elapsed_s']:.2f}s, {report['throughput_rps']:.0f} req/s")
+    print(f"overall  p50 {report['p50_ms']:.1f} ms  p95 {report['p95_ms']:.1f} ms  p99 {report['p99_ms']:.1f} ms")
+    for intent, entry in report["intents"].items():
+        print(f"{intent}")
+        print(f"  {entry['requests']} requests ({entry['failures']} failed)  p50 {entry['p50_ms']:.1f} ms  p95 {entry['p95_ms']:.1f} ms  p99 {entry['p99_ms']:.1f} ms")
+        if "store_calls" in entry:
+            calls = ", ".join(f"{method}={count}" for method, count in entry["store_calls"].items())
+            print(f"  store calls/request {entry['store_calls_per_request']:.2f} ({calls or 'none'})")
+    if report.get("background_store_calls"):
+        calls = ", ".join(f"{method}={count}" for method, count in report["background_store_calls"].items())
+        print(f"background store calls ({calls})")
+
+
+def check_thresholds(report, max_p95_ms, max_store_calls):
+    failures = [
+        f"{intent}: {entry['failures']} failed replies"
+        for intent, entry in report["intents"].items() if entry["failures"]
+    ]
+    if max_p95_ms is not None and report["p95_ms"] > max_p95_ms:
+        failures.append(f"p95 {report['p95_ms']:.1f} ms exceeds {max_p95_ms} ms")
+    if max_store_calls is not None:
+        for intent, entry in report["intents"].items():
+            per_request = entry.get("store_calls_per_request", 0)
+            if per_request > max_store_calls:
+                failures.append(f"{intent}: {per_request:.2f} store calls/request exceeds {max_store_calls}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--traffic", default=os.path.join(BENCH_DIR, "traffic.jsonl"))
+    parser.add_argument("--target", default="flask", help="flask, asgi or a server URL")
+    parser.add_argument("--concurrency", type=int, default=8, help="sessions replayed at once")
+    parser.add_argument("--iterations", type=int, default=10, help="times each session is replayed")
+    parser.add_argument("--latency-ms", type=float, default=10.0, help="injected per store call")
+    parser.add_argument("--write-behind", action="store_true", help="group-commit order writes")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-p95-ms", type=float, help="fail if overall p95 exceeds this")
+    parser.add_argument("--max-store-calls", type=float, help="fail if any intent averages more store calls per request")
+    args = parser.parse_args()
+
+    sessions = load_sessions(args.traffic)
+    latency = args.latency_ms / 1000
+    results = Results()
+    counter_holder = []
+
+    if args.target == "flask":
+        call = flask_target(latency, counter_holder, args.write_behind)
+        elapsed = run_threaded(call, sessions, args.iterations, args.concurrency, results)
+    elif args.target == "asgi":
+        elapsed = asyncio.run(run_async(
+            sessions, args.iterations, args.concurrency, latency, results, counter_holder, args.write_behind
+        ))
+    else:
+        elapsed = run_threaded(http_target(args.target), sessions, args.iterations, args.concurrency, results)
+
+    report = summarize(results, elapsed, counter_holder[0] if counter_holder else None)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    failures = check_thresholds(report, args.max_p95_ms, args.max_store_calls)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+import deadlines
+from storage import AsyncStoreWrapper, OrderExists, OrderNotFound, OrderRejected, StoreWrapper
+
+try:
+    from google.api_core.exceptions import GoogleAPIError
+except ImportError:  # only the Firestore backend needs it
+    GoogleAPIError = None
+
+# Fails store calls fast while the store is unhealthy. After BREAKER_FAILURES
+# failed calls in a row the breaker opens and every call raises
+# StoreUnavailable at once, without touching the store, so the handlers can
+# send a degraded reply well inside Dialogflow's deadline instead of each
+# waiting out its own timeout. After BREAKER_RESET seconds one call is let
+# through as a trial: if it succeeds the breaker closes, if not it opens
+# again. Only store and transport errors count as failures: missing or
+# duplicate orders and rejected changes are answers, and anything else (a
+# bug, bad input, a full write-behind queue) says nothing about the store.
+# A group commit that fails is one failure however many callers it fails.
+#
+# GuardedStore and GuardedAsyncStore also refuse calls once the request's
+# deadline (see deadlines.py) has passed.
+#
+#   BREAKER_FAILURES   failures in a row that open the breaker (default 5)
+#   BREAKER_RESET      seconds the breaker stays open before a trial call (default 10)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+# Outcomes that show the store is working
+_ANSWERS = (OrderNotFound, OrderExists, OrderRejected)
+
+# Errors that show it isn't; OSError covers lost connections
+_FAILURES = (OSError, asyncio.TimeoutError, sqlite3.Error) + ((GoogleAPIError,) if GoogleAPIError is not None else ())
+
+
+class StoreUnavailable(Exception):
+    # The call was refused without reaching the store
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failures=None, reset_after=None):
+        self._threshold = int(failures if failures is not None else os.environ.get("BREAKER_FAILURES", 5))
+        self._reset_after = float(reset_after if reset_after is not None else os.environ.get("BREAKER_RESET", 10))
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self.opens = 0
+        self.rejected = 0
+
+    def before_call(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self._reset_after:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            self.rejected += 1
+        raise StoreUnavailable("Order store unavailable (circuit breaker open)")
+
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._trial = False
+            if self.state != CLOSED:
+                logging.info("Store circuit breaker closed")
+                self.state = CLOSED
+
+    def failed(self, error=None):
+        # Callers sharing one error (a failed group commit) count it once
+        with self._lock:
+            self._trial = False
+            if error is not None:
+                if getattr(error, "_breaker_counted", False):
+                    return
+                error._breaker_counted = True
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self._threshold):
+                if self.state == CLOSED:
+                    logging.warning("Store circuit breaker opened after %d failures", self._failures)
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.opens += 1
+
+    def ignored(self):
+        # The call ended without telling us anything about the store
+        with self._lock:
+            self._trial = False
+
+    def stats(self):
+        return {"state": self.state, "opens": self.opens, "rejected": self.rejected}
+
+
+def _budget():
+    # Seconds left for the request, or None outside one; refuses the call
+    # once there are none
+    remaining = deadlines.remaining()
+    if remaining is not None and remaining <= 0:
+        raise StoreUnavailable("Request deadline passed")
+    return remaining
+
+
+def _record(breaker, error, remaining):
+    if error is None or isinstance(error, _ANSWERS):
+        breaker.succeeded()
+    elif not isinstance(error, _FAILURES):
+        breaker.ignored()
+    elif remaining is not None and remaining < deadlines.STORE_CALL_TIMEOUT and deadlines.remaining() <= 0:
+        # Cut short by the request's own budget, not by the store
+        breaker.ignored()
+    else:
+        breaker.failed(error)
+
+
+class GuardedStore(StoreWrapper):
+    def __init__(self, store, breaker):
+        super().__init__(store)
+        self._breaker = breaker
+
+    def _call(self, operation, *args, **kwargs):
+        remaining = _budget()
+        self._breaker.before_call()
+        try:
+            result = getattr(self._store, operation)(*args, **kwargs)
+        except Exception as e:
+            _record(self._breaker, e, remaining)
+            raise
+        _record(self._breaker, None, remaining)
+        return result
+
+
+class GuardedAsyncStore(AsyncStoreWrapper):
+    # GuardedStore for the ASGI webhook; a call is also cancelled when the
+    # request's deadline passes, since a transaction's commit has no
+    # timeout of its own
+
+    def __init__(self, store, breaker):
+        super().__init__(store)
+        self._breaker = breaker
+        self.menu_store = GuardedStore(store.menu_store, breaker)
+
+    async def _call(self, operation, *args, **kwargs):
+        remaining = _budget()
+        self._breaker.before_call()
+        try:
+            result = await asyncio.wait_for(getattr(self._store, operation)(*args, **kwargs), remaining)
+        except Exception as e:
+            _record(self._breaker, e, remaining)
+            raise
+        except BaseException:
+            # Cancelled; the store may be fine
+            self._breaker.ignored()
+            raise
+        _record(self._breaker, None, remaining)
+        return result
@@ -0,0 +1,42 @@
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+
+# Dialogflow waits about 5 seconds for the webhook before giving the user
+# its own timeout message. webhook() starts a deadline for each request and
+# every store call gets the time that is left, capped at STORE_CALL_TIMEOUT,
+# as its gRPC timeout, so a slow Firestore call fails while there is still
+# time to send our own reply. Calls outside a request (write-behind and
+# deferred commits, warm-up) get the cap.
+#
+#   WEBHOOK_DEADLINE     seconds a request may spend on store calls (default 4.5)
+#   STORE_CALL_TIMEOUT   seconds one store call may take (default 2.5)
+
+WEBHOOK_DEADLINE = float(os.environ.get("WEBHOOK_DEADLINE", 4.5))
+STORE_CALL_TIMEOUT = float(os.environ.get("STORE_CALL_TIMEOUT", 2.5))
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def request_deadline(seconds=None):
+    token = _deadline.set(time.monotonic() + (seconds if seconds is not None else WEBHOOK_DEADLINE))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    # Seconds left for the current request, or None outside one
+    deadline = _deadline.get()
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+def call_timeout():
+    left = remaining()
+    if left is None:
+        return STORE_CALL_TIMEOUT
+    # Never zero; the caller checks for a spent deadline before calling
+    return max(min(left, STORE_CALL_TIMEOUT), 0.001)
@@ -0,0 +1,146 @@
+import re
+import json
+import string
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+# Parsing of Dialogflow webhook calls and encoding of the replies, shared by
+# app.py and asgi.py. A call is read once into a WebhookRequest holding only
+# the fields the handlers use, already flattened and coerced. Replies are
+# Reply dicts that carry their encoded JSON body; fixed replies are encoded
+# once at import and ReplyTemplate replies skip the JSON encoder when their
+# values need no escaping. With orjson installed it decodes and encodes the
+# JSON, otherwise the json module does.
+
+_REPLY_OPEN = b'{"fulfillmentText":"'
+_REPLY_CLOSE = b'"}'
+# Characters a JSON string can't hold as they are
+_NEEDS_ESCAPE = re.compile(r'["\\\x00-\x1f]')
+
+
+if orjson is not None:
+    loads = orjson.loads
+    dumps = orjson.dumps
+else:
+    loads = json.loads
+
+    def dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _escape(text):
+    # text as the inside of a JSON string
+    return dumps(text)[1:-1]
+
+
+class Reply(dict):
+    """A webhook reply, ``{"fulfillmentText": text}``, with its JSON body."""
+
+    __slots__ = ("body",)
+
+    def __init__(self, text, body=None):
+        super().__init__(fulfillmentText=text)
+        self.body = body if body is not None else _REPLY_OPEN + _escape(text) + _REPLY_CLOSE
+
+
+class ReplyTemplate:
+    """A reply text with plain ``{name}`` fields; calling it returns a Reply.
+
+    The fixed text is checked once here, so a reply whose values need no
+    escaping (amounts, order IDs) is encoded as it is, without the JSON
+    encoder.
+    """
+
+    __slots__ = ("_text",)
+
+    def __init__(self, text):
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if spec or conversion:
+                raise ValueError(f"Reply template fields take no format spec: {text!r}")
+            if _NEEDS_ESCAPE.search(literal):
+                raise ValueError(f"Reply template text must not need escaping: {text!r}")
+        self._text = text
+
+    def __call__(self, **values):
+        text = self._text.format(**values)
+        if _NEEDS_ESCAPE.search(text):
+            return Reply(text)
+        return Reply(text, _REPLY_OPEN + text.encode() + _REPLY_CLOSE)
+
+
+def encode_reply(reply):
+    body = getattr(reply, "body", None)
+    # Replies read back from the shared response store are plain dicts
+    return body if body is not None else dumps(reply)
+
+
+class WebhookRequest:
+    """The parts of a Dialogflow webhook call the handlers use.
+
+    ``menu_items`` is a flat list of strings; ``quantities`` is a flat list
+    with each quantity as an int, or None where it wasn't a whole number.
+    """
+
+    __slots__ = ("intent", "session", "response_id", "menu_items", "quantities", "order_id")
+
+    def __init__(self, intent, session="", response_id="", menu_items=None, quantities=None, order_id=""):
+        self.intent = intent
+        self.session = session
+        self.response_id = response_id
+        self.menu_items = menu_items if menu_items is not None else []
+        self.quantities = quantities if quantities is not None else []
+        self.order_id = order_id
+
+    @classmethod
+    def from_payload(cls, payload):
+        if not isinstance(payload, dict):
+            raise ValueError("Request body must be a JSON object.")
+        query = _mapping(payload.get("queryResult"))
+        intent = _mapping(query.get("intent")).get("displayName")
+        if not intent or not isinstance(intent, str):
+            raise ValueError("Intent not found in the request.")
+        parameters = _mapping(query.get("parameters"))
+        return cls(
+            intent,
+            str(payload.get("session") or ""),
+            str(payload.get("responseId") or ""),
+            [str(item) for item in _flat_list(parameters.get("menu_item"))],
+            [parse_quantity(quantity) for quantity in _flat_list(parameters.get("quantity"))],
+            str(parameters.get("order_id") or ""),
+        )
+
+    def __repr__(self):
+        return f"WebhookRequest({self.intent!r}, menu_items={self.menu_items!r}, quantities={self.quantities!r}, order_id={self.order_id!r})"
+
+
+def parse_quantity(value):
+    # Dialogflow sends quantities as strings ("2") or numbers (2.0)
+    if type(value) is str:
+        return int(value) if value.strip().isdecimal() else None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value if value >= 0 else None
+    if isinstance(value, float):
+        return int(value) if value.is_integer() and value >= 0 else None
+    return None
+
+
+def _mapping(value):
+    return value if isinstance(value, dict) else {}
+
+
+def _flat_list(value):
+    # Dialogflow sometimes nests list parameters one level deep, and sends
+    # a single value for parameters not marked as lists
+    if value is None or value == "":
+        return []
+    if not isinstance(value, list):
+        return [value]
+    for entry in value:
+        if isinstance(entry, list):
+            return [item for entry in value for item in (entry if isinstance(entry, list) else (entry,))]
+    return value
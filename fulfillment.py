@@ -0,0 +1,192 @@
+import logging
+from datetime import datetime
+from dialogflow import Reply, ReplyTemplate
+from menu_cache import normalize_item_name
+from order_model import OrderItems
+from storage import DELETE_FIELD, OrderRejected
+
+# Order logic shared by the Flask (app.py) and ASGI (asgi.py) webhooks.
+# Nothing here talks to a store, so both can drive it with their own I/O.
+
+PLACE_ORDER_INTENT = "order_item_place"
+ADD_TO_ORDER_INTENT = "order.add - context: ongoing-order"
+REMOVE_FROM_ORDER_INTENT = "order.remove - context: ongoing-order"
+
+TOTAL_AMOUNT = ("totalAmount",)
+
+# Outcome of a reply, keyed on the fixed part of its fulfillmentText
+REPLY_PREFIXES = (
+    ("Your order has been placed", "ok"),
+    ("Your order has been received", "queued"),
+    ("Added items", "ok"),
+    ("Items removed", "ok"),
+    ("No valid menu items", "no_items"),
+    ("Please provide a valid Order ID", "missing_order_id"),
+    ("Order ID is missing", "missing_order_id"),
+    ("No order found", "order_not_found"),
+    ("Cannot remove", "insufficient_quantity"),
+    ("Invalid quantity", "invalid_quantity"),
+    ("Failed to", "store_error"),
+    ("An error occurred", "internal_error"),
+    ("I couldn't process", "unknown_intent"),
+    ("We're still working", "in_progress"),
+    ("We're still saving", "saving"),
+    ("We can't update your order", "unavailable"),
+    ("We're busy right now", "busy"),
+    ("Did you mean", "suggested"),
+)
+REPLY_SUFFIXES = (
+    ("is not available in the menu.", "not_on_menu"),
+    ("is not in your order.", "not_in_order"),
+)
+# Failures on our side; the same request may succeed if retried
+RETRYABLE_OUTCOMES = frozenset(("store_error", "internal_error", "unavailable", "busy"))
+
+# Replies, encoded once here
+NO_ITEMS_REPLY = Reply("No valid menu items provided.")
+ADD_MISSING_ORDER_ID_REPLY = Reply("Please provide a valid Order ID to add items.")
+REMOVE_MISSING_ORDER_ID_REPLY = Reply("Order ID is missing. Please provide a valid order ID.")
+ORDER_NOT_FOUND_REPLY = Reply("No order found with the provided Order ID.")
+INVALID_QUANTITY_REPLY = Reply("Invalid quantity provided. Please check your input and try again.")
+PLACE_FAILED_REPLY = Reply("Failed to place your order. Please try again later.")
+ADD_FAILED_REPLY = Reply("Failed to add items to your order. Please try again later.")
+REMOVE_FAILED_REPLY = Reply("Failed to remove items from your order. Please try again later.")
+UNKNOWN_INTENT_REPLY = Reply("I couldn't process that request.")
+INTERNAL_ERROR_REPLY = Reply("An error occurred while processing your request.")
+# Degraded reply while the store can't be reached
+ORDER_UNAVAILABLE_REPLY = Reply("We can't update your order right now. Please try again in a minute.")
+# Too many requests for the intent at once, see intent_router.py
+BUSY_REPLY = Reply("We're busy right now. Please try again in a moment.")
+
+ORDER_PLACED_REPLY = ReplyTemplate(
+    "Your order has been placed successfully! Order ID: {order_id}. Total amount: ₹{total_amount}. "
+    "If you wish to modify your order, please provide this Order ID."
+)
+# The order was queued to be saved later, see DeferredWrites
+ORDER_RECEIVED_REPLY = ReplyTemplate(
+    "Your order has been received! Order ID: {order_id}. Total amount: ₹{total_amount}. "
+    "It may take a few minutes to be confirmed, so please wait a little before changing it."
+)
+ITEMS_QUOTED_REPLY = ReplyTemplate(
+    "We can't update your order right now. The items you asked for come to ₹{amount}; please try again in a minute."
+)
+# The write may or may not have been applied (WriteOutcomeUnknown); asking
+# again could apply it twice
+ORDER_SAVING_REPLY = ReplyTemplate(
+    "We're still saving your order. Order ID: {order_id}. Total amount: ₹{total_amount}. "
+    "Please check on it in a minute before placing it again."
+)
+CHANGE_SAVING_REPLY = Reply(
+    "We're still saving your change. Please check your order in a minute before asking again."
+)
+ITEMS_ADDED_REPLY = ReplyTemplate("Added items to your order. Updated total: ₹{total_amount}.")
+ITEMS_REMOVED_REPLY = ReplyTemplate("Items removed successfully! Updated total amount: ₹{total_amount}.")
+ORDER_ID_NOT_FOUND_REPLY = ReplyTemplate("No order found with ID {order_id}.")
+
+
+def reply_outcome(text):
+    for prefix, outcome in REPLY_PREFIXES:
+        if text.startswith(prefix):
+            return outcome
+    for suffix, outcome in REPLY_SUFFIXES:
+        if text.endswith(suffix):
+            return outcome
+    return "other"
+
+
+def is_retryable(reply):
+    return reply_outcome(reply.get("fulfillmentText", "")) in RETRYABLE_OUTCOMES
+
+
+def quantity_at(quantities, i, lenient=False):
+    # The i-th of WebhookRequest.quantities, 1 if there is none; an invalid
+    # one counts as 1 if lenient, else raises ValueError
+    if i >= len(quantities):
+        return 1
+    quantity = quantities[i]
+    if quantity is None:
+        if lenient:
+            return 1
+        raise ValueError("Invalid quantity")
+    return quantity
+
+
+def remove_quantities(items, quantities):
+    # quantity_at for each item to remove, checked before the order is
+    # read; raises ValueError for an invalid one
+    return [quantity_at(quantities, i) for i in range(len(items))]
+
+
+def price_items(items, quantities, menu_prices, lenient_quantities=False):
+    # Returns (OrderItems, amount); raises OrderRejected for unknown items
+    order_items = OrderItems()
+    amount = 0
+
+    for i, item in enumerate(items):
+        name = menu_prices.resolve(item)
+        quantity = quantity_at(quantities, i, lenient_quantities)
+
+        price = menu_prices.get(name) if name else None
+        if not price:
+            # A near miss is asked about, never charged for
+            suggestion = menu_prices.suggest(item) if name is None else None
+            if suggestion is not None:
+                raise OrderRejected(f"Did you mean {menu_prices.display_name(suggestion)}? '{item}' is not on the menu.")
+            raise OrderRejected(f"Item '{item}' is not available in the menu.")
+
+        order_items.add(menu_prices.display_name(name), quantity)
+        amount += price * quantity
+
+    return order_items, amount
+
+
+def new_order(order_id, order_items, total_amount):
+    return {
+        "orderId": order_id,
+        "items": order_items.to_firestore(),
+        "totalAmount": total_amount,
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+def add_increments(order_items, amount):
+    # Field increments and display names for OrderStore.increment_order
+    increments = {("items", key, "quantity"): line.quantity for key, line in order_items.lines.items()}
+    increments[TOTAL_AMOUNT] = amount
+    names = {("items", key, "item"): line.item for key, line in order_items.lines.items()}
+    return increments, names
+
+
+def remove_items(current_order, items_to_remove, quantities, menu_prices):
+    # mutate_order body for the remove intent: returns the fields to write
+    order_items = OrderItems.from_order(current_order)
+    total_amount = current_order.get("totalAmount", 0)
+
+    logging.debug("Fetched order: %s", current_order)
+
+    for i, item in enumerate(items_to_remove):
+        # Lines for items since taken off the menu can still be removed by
+        # their exact name
+        name = menu_prices.resolve(item) or normalize_item_name(item)
+        quantity_to_remove = quantity_at(quantities, i)
+
+        logging.debug("Attempting to remove item: %s, quantity: %d", name, quantity_to_remove)
+
+        order_item = order_items.lines.get(name)
+        if order_item is None:
+            logging.warning("Item not found in order: %s", name)
+            raise OrderRejected(f"Item '{item}' is not in your order.")
+
+        if order_item.quantity < quantity_to_remove:
+            logging.warning("Not enough quantity for item: %s", name)
+            raise OrderRejected(
+                f"Cannot remove {quantity_to_remove} {item}(s). You only have {order_item.quantity} in the order."
+            )
+
+        order_items.remove(name, quantity_to_remove)
+        total_amount -= menu_prices.get(name, 0) * quantity_to_remove
+
+    logging.debug("Updated items: %s, total_amount: %s", order_items.lines, total_amount)
+    fields = order_items.to_fields(DELETE_FIELD)
+    fields["totalAmount"] = total_amount
+    return fields
@@ -0,0 +1,57 @@
+import os
+import importlib
+from order_ids import MAX_WORKER, order_ids
+
+# Production server settings; Procfile runs `gunicorn --config gunicorn.conf.py`.
+#   SERVER_MODE       wsgi (Flask app.py, default) or asgi (asgi.py on uvicorn workers)
+#   WEB_CONCURRENCY   worker processes (default 2)
+#   GUNICORN_THREADS  threads per worker in wsgi mode (default 8)
+#   METRICS_DIR       directory shared by the workers so /metrics covers all of them
+#   ORDER_ID_NODE     this dyno's order ID host number, 0-63, unique per dyno
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+server_mode = os.environ.get("SERVER_MODE", "wsgi").lower()
+if server_mode == "asgi":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "app:app"
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+if workers > MAX_WORKER + 1:
+    raise ValueError(f"WEB_CONCURRENCY can be at most {MAX_WORKER + 1}: each worker needs its own order ID slot")
+
+# Import the app once in the master so forked workers start warm. Nothing
+# touches Firestore at import time: each worker opens its own client and
+# gRPC channel after fork (gRPC channels must not cross a fork).
+preload_app = True
+
+# Dialogflow gives up after ~5s; don't hold workers much longer than that
+timeout = 30
+graceful_timeout = 10
+keepalive = 5
+
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def post_worker_init(worker):
+    # Open the store client and load the menu in the background so the
+    # worker's first webhook doesn't pay for it. The ASGI app does this
+    # itself on lifespan startup, inside the worker's event loop.
+    if server_mode != "asgi":
+        importlib.import_module(wsgi_app.split(":")[0]).warm_up()
+
+
+def pre_fork(server, worker):
+    # In the master: the lowest order ID worker slot no live worker holds,
+    # so a recycled worker takes over the slot of the one it replaces
+    taken = {getattr(live, "order_id_worker", None) for live in server.WORKERS.values()}
+    worker.order_id_worker = min(slot for slot in range(MAX_WORKER + 1) if slot not in taken)
+
+
+def post_fork(server, worker):
+    order_ids.set_worker(worker.order_id_worker)
@@ -0,0 +1,235 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dialogflow import Reply
+from fulfillment import is_retryable
+
+# Dialogflow retries a webhook call that times out, with the same session
+# and responseId. Replies are remembered under that pair so a retry gets the
+# first reply back instead of placing or changing the order a second time,
+# and a retry that arrives while the first call is still running waits for
+# it. Replies for failures on our side aren't kept, so those retries run.
+#
+#   IDEMPOTENCY_CACHE_SIZE   replies kept per worker (default 10000)
+#   IDEMPOTENCY_TTL          seconds a reply is kept (default 600)
+#   IDEMPOTENCY_WAIT         seconds a retry waits for the first call (default 4)
+#   IDEMPOTENCY_SHARED       1 to also record requests in the order store,
+#                            which catches retries that reach another worker
+
+IN_PROGRESS_REPLY = Reply("We're still working on your previous request. Please try again in a moment.")
+
+
+def request_key(req):
+    # req is a dialogflow.WebhookRequest
+    if not req.response_id:
+        return None
+    # Fixed length and safe as a Firestore document ID
+    return hashlib.sha1(f"{req.session}\n{req.response_id}".encode()).hexdigest()
+
+
+class _Pending:
+    # A request being handled; duplicates wait here for its reply, from
+    # threads (Flask) or from the event loop (ASGI)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._futures = []
+        self.reply = None
+
+    def resolve(self, reply):
+        with self._lock:
+            self.reply = reply
+            self._done.set()
+            futures, self._futures = self._futures, []
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_set_result, future, reply)
+
+    def wait(self, timeout):
+        self._done.wait(timeout)
+        return self.reply
+
+    async def wait_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._done.is_set():
+                return self.reply
+            future = loop.create_future()
+            self._futures.append((loop, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def _set_result(future, reply):
+    if not future.done():
+        future.set_result(reply)
+
+
+class ResponseCache:
+    """Per-worker LRU of webhook replies, optionally backed by the store."""
+
+    def __init__(self, store=None, max_entries=None, ttl=None, wait=None, shared=None):
+        self._store = store
+        self._max_entries = int(max_entries if max_entries is not None else os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+        self._ttl = float(ttl if ttl is not None else os.environ.get("IDEMPOTENCY_TTL", 600))
+        self._wait = float(wait if wait is not None else os.environ.get("IDEMPOTENCY_WAIT", 4))
+        if shared is None:
+            shared = os.environ.get("IDEMPOTENCY_SHARED") == "1"
+        self._shared = shared and store is not None
+        self._lock = threading.Lock()
+        self._replies = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.waits = 0
+        self.evictions = 0
+
+    def handle(self, req, handler):
+        # Reply to req, calling handler() unless this is a repeat
+        key = request_key(req)
+        if key is None:
+            return handler()
+
+        reply, pending = self._begin(key)
+        if reply is not None:
+            return reply
+        if pending is not None:
+            return pending.wait(self._wait) or IN_PROGRESS_REPLY
+
+        if self._shared:
+            record = self._claim(key)
+            if record is not None:
+                self._finish(key, record.get("reply"))
+                return record.get("reply") or IN_PROGRESS_REPLY
+
+        reply = None
+        try:
+            reply = handler()
+        finally:
+            kept = self._finish(key, reply)
+            if self._shared:
+                if kept:
+                    self._save(key, reply)
+                else:
+                    self._release(key)
+        return reply
+
+    def middleware(self, req, handler):
+        # handle() as intent_router middleware
+        return self.handle(req, lambda: handler(req))
+
+    async def async_middleware(self, req, handler):
+        return await self.handle_async(req, lambda: handler(req))
+
+    async def handle_async(self, req, handler):
+        # As handle(), for a coroutine function handler and an AsyncOrderStore
+        key = request_key(req)
+        if key is None:
+            return await handler()
+
+        reply, pending = self._begin(key)
+        if reply is not None:
+            return reply
+        if pending is not None:
+            return await pending.wait_async(self._wait) or IN_PROGRESS_REPLY
+
+        if self._shared:
+            record = await self._claim_async(key)
+            if record is not None:
+                self._finish(key, record.get("reply"))
+                return record.get("reply") or IN_PROGRESS_REPLY
+
+        reply = None
+        try:
+            reply = await handler()
+        finally:
+            kept = self._finish(key, reply)
+            if self._shared:
+                if kept:
+                    await self._save_async(key, reply)
+                else:
+                    await self._release_async(key)
+        return reply
+
+    def stats(self):
+        return {"hits": self.hits, "waits": self.waits, "evictions": self.evictions, "entries": len(self._replies)}
+
+    def _begin(self, key):
+        # (cached reply, None), (None, pending call to wait for), or
+        # (None, None) when the caller is first and must handle the request
+        with self._lock:
+            entry = self._replies.get(key)
+            if entry is not None:
+                expires, reply = entry
+                if expires > time.monotonic():
+                    self._replies.move_to_end(key)
+                    self.hits += 1
+                    return reply, None
+                del self._replies[key]
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.waits += 1
+                return None, pending
+            self._pending[key] = _Pending()
+            return None, None
+
+    def _finish(self, key, reply):
+        # Wakes any waiting duplicates and keeps the reply if it's final;
+        # returns whether it was kept
+        keep = reply is not None and not is_retryable(reply)
+        with self._lock:
+            pending = self._pending.pop(key, None)
+            if keep:
+                self._replies[key] = (time.monotonic() + self._ttl, reply)
+                while len(self._replies) > self._max_entries:
+                    self._replies.popitem(last=False)
+                    self.evictions += 1
+        if pending is not None:
+            pending.resolve(reply)
+        return keep
+
+    # The shared record is an optimization: if the store can't be reached
+    # the request is still handled, just without cross-worker protection.
+
+    def _claim(self, key):
+        try:
+            return self._store.claim_response(key, self._ttl)
+        except Exception as e:
+            logging.warning("Failed to claim request %s: %s", key, e)
+            return None
+
+    def _save(self, key, reply):
+        try:
+            self._store.save_response(key, reply, self._ttl)
+        except Exception as e:
+            logging.warning("Failed to save reply for request %s: %s", key, e)
+
+    def _release(self, key):
+        try:
+            self._store.release_response(key)
+        except Exception as e:
+            logging.warning("Failed to release request %s: %s", key, e)
+
+    async def _claim_async(self, key):
+        try:
+            return await self._store.claim_response(key, self._ttl)
+        except Exception as e:
+            logging.warning("Failed to claim request %s: %s", key, e)
+            return None
+
+    async def _save_async(self, key, reply):
+        try:
+            await self._store.save_response(key, reply, self._ttl)
+        except Exception as e:
+            logging.warning("Failed to save reply for request %s: %s", key, e)
+
+    async def _release_async(self, key):
+        try:
+            await self._store.release_response(key)
+        except Exception as e:
+            logging.warning("Failed to release request %s: %s", key, e)
@@ -1,54 +1,44 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
+# Default menu, also used to seed the local (memory/sqlite) order stores
+MENU_PRICES = {
+    "Pav Bhaji": 150,
+    "Chilli Potatoes": 180,
+    "Chilli Paneer": 220,
+    "Pakoda": 120,
+    "Maggi": 100,
+    "Fries": 120,
+    "Garlic Bread": 160,
+    "Wrap": 200,
+    "Pizza": 400,
+    "Burger": 250,
+    "Oreo Shake": 180,
+    "Chocolate Shake": 200,
+    "Strawberry Shake": 190,
+    "Vanilla Shake": 170,
+    "Mojito": 150,
+    "Fresh Lime Soda": 120,
+    "Fresh Juice": 180,
+    "Masala Soda": 140,
+    "Biryani": 350,
+    "Samosa": 80,
+    "Lassi": 150,
+    "Dosa": 220,
+    "Mango Lassi": 180
+}
 
-# Initialize Firebase Admin SDK
-def initialize_firebase():
-    try:
-        cred = credentials.Certificate('serviceaccount.json')  # Replace with your service account file
-        firebase_admin.initialize_app(cred)
-        return firestore.client()
-    except Exception as e:
-        print(f"Error initializing Firebase: {e}")
-        raise
 
-# Add menu items to Firestore
+# Add menu items to Firestore. Only new or repriced items are written, in
+# batched commits; items missing from MENU_PRICES are left alone (use
+# menu_sync.py to replace the whole menu).
 def add_menu_items():
-    db = initialize_firebase()
-    menu_prices = {
-        "Pav Bhaji": 150,
-        "Chilli Potatoes": 180,
-        "Chilli Paneer": 220,
-        "Pakoda": 120,
-        "Maggi": 100,
-        "Fries": 120,
-        "Garlic Bread": 160,
-        "Wrap": 200,
-        "Pizza": 400,
-        "Burger": 250,
-        "Oreo Shake": 180,
-        "Chocolate Shake": 200,
-        "Strawberry Shake": 190,
-        "Vanilla Shake": 170,
-        "Mojito": 150,
-        "Fresh Lime Soda": 120,
-        "Fresh Juice": 180,
-        "Masala Soda": 140,
-        "Biryani": 350,
-        "Samosa": 80,
-        "Lassi": 150,
-        "Dosa": 220,
-        "Mango Lassi": 180
-    }
+    from menu_sync import sync_menu
+    from storage import FirestoreStore
 
     try:
-        # Reference to the 'menu_prices' collection
-        menu_collection = db.collection("menu_prices")
-
-        for item, price in menu_prices.items():
-            # Add each item as a document
-            menu_collection.document(item).set({"price": price})
-
-        print("Menu items added successfully.")
+        upserts, _, version = sync_menu(FirestoreStore('serviceaccount.json'), MENU_PRICES, prune=False)  # Replace with your service account file
+        if version is None:
+            print("Menu items already up to date.")
+        else:
+            print(f"Menu items added successfully ({len(upserts)} written, menu version {version}).")
     except Exception as e:
         print(f"Error adding menu items: {e}")
 
@@ -0,0 +1,179 @@
+import os
+import asyncio
+import threading
+from collections import deque
+import deadlines
+from log_config import parse_rates
+
+# Maps Dialogflow intent display names to their handlers. A handler
+# registers with
+#
+#   @router.intent(PLACE_ORDER_INTENT, response_cache.middleware, metrics.time_handler)
+#   def handle_place_order(req): ...
+#
+# and dispatch is one dict lookup on req.intent; unknown intents go to the
+# fallback. Middleware is listed outermost first and composed once, at
+# registration. A middleware is called as middleware(req, handler) and calls
+# handler(req) to carry on; with AsyncIntentRouter both are coroutine
+# functions.
+#
+# Each intent can be limited to a number of requests in flight, so a slow
+# one (remove runs a transaction) can't take every worker thread from the
+# others. Limits are off unless configured. The limit sits just around the
+# handler, so replayed replies don't need a slot. A request that finds the
+# intent full queues for a slot, first come first served, for up to
+# INTENT_QUEUE_TIMEOUT seconds or what is left of its deadline, and then
+# gets the busy reply.
+#
+#   INTENT_MAX_CONCURRENT   requests in flight per intent (default 0, no limit)
+#   INTENT_CONCURRENCY      per-intent limits, e.g. "order.remove - context: ongoing-order=4"
+#   INTENT_QUEUE_TIMEOUT    seconds a request waits for a free slot (default 0.5)
+
+
+def compose(handler, middleware):
+    # handler wrapped so middleware[0] runs first
+    for layer in reversed(middleware):
+        handler = _bind(layer, handler)
+    return handler
+
+
+def _bind(layer, handler):
+    return lambda req: layer(req, handler)
+
+
+class _Route:
+    __slots__ = ("intent", "call", "limit", "in_flight", "busy")
+
+    def __init__(self, intent, limit):
+        self.intent = intent
+        self.call = None
+        self.limit = limit
+        self.in_flight = 0
+        self.busy = 0
+
+
+class _FairSlots:
+    # Counting semaphore that hands a freed slot to the longest waiter, so
+    # no request waits out its timeout while later ones get through
+
+    def __init__(self, limit):
+        self._free = limit
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    def acquire(self, timeout):
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return True
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        if waiter.wait(timeout):
+            return True
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                # Handed a slot just as the wait ran out
+                return True
+        return False
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._free += 1
+
+
+class IntentRouter:
+    def __init__(self, fallback, busy_reply, max_concurrent=None, queue_timeout=None):
+        env = os.environ.get
+        self._fallback = fallback
+        self._busy_reply = busy_reply
+        self._max_concurrent = int(max_concurrent if max_concurrent is not None else env("INTENT_MAX_CONCURRENT", 0))
+        self._limits = {intent: int(limit) for intent, limit in parse_rates(env("INTENT_CONCURRENCY", "")).items()}
+        self._queue_timeout = float(queue_timeout if queue_timeout is not None else env("INTENT_QUEUE_TIMEOUT", 0.5))
+        self._routes = {}
+
+    def intent(self, name, *middleware, max_concurrent=None):
+        # Decorator registering the handler for intent name
+        def register(handler):
+            if name in self._routes:
+                raise ValueError(f"Intent {name!r} is already registered")
+            limit = self._limits.get(name, max_concurrent if max_concurrent is not None else self._max_concurrent)
+            route = _Route(name, limit)
+            route.call = compose(self._limited(route, handler) if limit > 0 else handler, middleware)
+            self._routes[name] = route
+            return handler
+        return register
+
+    def dispatch(self, req):
+        route = self._routes.get(req.intent)
+        if route is None:
+            return self._fallback(req)
+        return route.call(req)
+
+    def intents(self):
+        return list(self._routes)
+
+    def stats(self):
+        return {
+            name: {"limit": route.limit, "in_flight": route.in_flight, "busy": route.busy}
+            for name, route in self._routes.items()
+        }
+
+    def _wait(self):
+        remaining = deadlines.remaining()
+        return self._queue_timeout if remaining is None else max(min(self._queue_timeout, remaining), 0)
+
+    def _limited(self, route, handler):
+        slots = _FairSlots(route.limit)
+        lock = threading.Lock()
+
+        def limited(req):
+            if not slots.acquire(timeout=self._wait()):
+                with lock:
+                    route.busy += 1
+                return self._busy_reply
+            with lock:
+                route.in_flight += 1
+            try:
+                return handler(req)
+            finally:
+                with lock:
+                    route.in_flight -= 1
+                slots.release()
+
+        return limited
+
+
+class AsyncIntentRouter(IntentRouter):
+    # IntentRouter for coroutine handlers and middleware (asgi.py)
+
+    async def dispatch(self, req):
+        route = self._routes.get(req.intent)
+        if route is None:
+            return await self._fallback(req)
+        return await route.call(req)
+
+    def _limited(self, route, handler):
+        slots = asyncio.Semaphore(route.limit)
+
+        async def limited(req):
+            if not slots.locked():
+                await slots.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(slots.acquire(), self._wait())
+                except asyncio.TimeoutError:
+                    route.busy += 1
+                    return self._busy_reply
+            route.in_flight += 1
+            try:
+                return await handler(req)
+            finally:
+                route.in_flight -= 1
+                slots.release()
+
+        return limited
@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+# Logging for the webhook processes:
+#   - records go onto an in-memory queue and a background thread formats
+#     and writes them, so request threads never block on stdout
+#   - output is one JSON object per line; anything passed via extra={...}
+#     becomes a field
+#   - full Dialogflow payloads are only logged for a sample of requests
+#
+#   LOG_LEVEL                  root level (default INFO)
+#   LOG_PAYLOAD_SAMPLE_RATE    fraction of requests whose payload is logged (default 0.01)
+#   LOG_PAYLOAD_SAMPLE_RATES   per-intent overrides, e.g. "order_item_place=0.1,order.remove - context: ongoing-order=1"
+
+_STANDARD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler renders the message in the calling thread;
+    # leave the record untouched so formatting happens on the listener.
+    def prepare(self, record):
+        return record
+
+
+class PayloadSampler:
+    def __init__(self, default_rate=None, rates=None):
+        if default_rate is None:
+            default_rate = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", 0.01))
+        if rates is None:
+            rates = parse_rates(os.environ.get("LOG_PAYLOAD_SAMPLE_RATES", ""))
+        self.default_rate = default_rate
+        self.rates = rates
+
+    def sample(self, intent):
+        rate = self.rates.get(intent, self.default_rate)
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def parse_rates(spec):
+    rates = {}
+    for part in spec.split(","):
+        if "=" in part:
+            intent, rate = part.rsplit("=", 1)
+            rates[intent.strip()] = float(rate)
+    return rates
+
+
+def configure_logging(level=None, stream=None):
+    global _listener
+
+    if _listener is not None:
+        return
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    # Drains the queue; records logged after this are dropped
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_listener():
+    # The listener thread does not survive fork (gunicorn preloads the app
+    # in the master), so each worker starts its own
+    if _listener is not None:
+        _listener._thread = None
+        _listener.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_listener)
+
+
+payload_sampler = PayloadSampler()
@@ -0,0 +1,187 @@
+import os
+import logging
+import threading
+import time
+from collections.abc import Mapping
+from menu_matcher import MenuMatcher, normalize_item_name
+
+
+class MenuPrices(Mapping):
+    # Normalized name -> price, read-only so handlers can share it safely.
+    # resolve() maps what a customer said onto those names.
+
+    __slots__ = ("_prices", "_display_names", "_matcher")
+
+    def __init__(self, menu):
+        self._prices = {}
+        self._display_names = {}
+        for name, price in menu.items():
+            if price:
+                key = normalize_item_name(name)
+                self._prices[key] = price
+                self._display_names[key] = name
+        self._matcher = MenuMatcher(self._prices)
+
+    def __getitem__(self, key):
+        return self._prices[key]
+
+    def get(self, key, default=None):
+        return self._prices.get(key, default)
+
+    def __iter__(self):
+        return iter(self._prices)
+
+    def __len__(self):
+        return len(self._prices)
+
+    def resolve(self, item):
+        # The menu name for item, allowing plurals and typos; None if nothing fits
+        return self._matcher.match(item)
+
+    def suggest(self, item):
+        # A menu name to offer back when resolve() finds none, or None
+        return self._matcher.suggest(item)
+
+    def display_name(self, key):
+        return self._display_names.get(key, key)
+
+
+# Seconds between refresh attempts while the cached menu is stale
+STALE_RETRY = 10
+
+
+def build_menu_prices(menu):
+    return MenuPrices(menu)
+
+
+class MenuCache:
+    """Process-wide menu price cache.
+
+    The menu is loaded once and then kept fresh by the store's menu watch
+    (a Firestore snapshot listener), which is re-armed if it stops on an
+    error. If the store cannot push changes, or watching is disabled, or
+    the listener has stopped, entries expire after ``ttl`` seconds; the next
+    lookup then reads the menu version (see menu_sync.py) and reloads the
+    menu only if the version moved. If that fails, the old menu is served
+    and the check retried after ``STALE_RETRY`` seconds.
+    """
+
+    def __init__(self, store, ttl=None, listen=None):
+        self._store = store
+        self._ttl = float(ttl if ttl is not None else os.environ.get("MENU_CACHE_TTL", 300))
+        if listen is None:
+            listen = os.environ.get("MENU_CACHE_LISTEN", "1") != "0"
+        self._listen = listen
+        self._lock = threading.Lock()
+        self._prices = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._watch = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.version_checks = 0
+
+    def prices(self):
+        prices = self._prices
+        if prices is not None and self._is_fresh():
+            self.hits += 1
+            return prices
+
+        with self._lock:
+            if self._watch is not None and not _active(self._watch):
+                # The listener stopped on an error: fall back to the
+                # version check until it is re-armed below
+                logging.warning("Menu snapshot listener stopped, re-arming it")
+                self._drop_watch()
+            if self._prices is None or not self._is_fresh():
+                self.misses += 1
+                try:
+                    self._revalidate()
+                except Exception as e:
+                    if self._prices is None:
+                        raise
+                    # Prices rarely change; keep quoting the old menu while
+                    # the store is down and try again a little later
+                    logging.warning("Menu refresh failed, serving the cached menu: %s", e)
+                    self._loaded_at = time.monotonic() - max(self._ttl - STALE_RETRY, 0)
+                if self._listen and self._watch is None:
+                    self._start_listener()
+            return self._prices
+
+    def peek(self):
+        # Fresh prices, or None if a lookup would have to load them; lets
+        # async callers move the load off the event loop
+        prices = self._prices
+        if prices is not None and self._is_fresh():
+            self.hits += 1
+            return prices
+        return None
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "version_checks": self.version_checks,
+            "version": self._version,
+            "items": len(self._prices or ()),
+            "listening": self._watch is not None and _active(self._watch),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+
+    def _is_fresh(self):
+        watch = self._watch
+        if watch is not None and _active(watch):
+            return True
+        return time.monotonic() - self._loaded_at < self._ttl
+
+    def _drop_watch(self):
+        watch, self._watch = self._watch, None
+        try:
+            watch.unsubscribe()
+        except Exception as e:
+            logging.debug("Unsubscribing the stopped menu listener failed: %s", e)
+
+    def _revalidate(self):
+        if self._prices is not None and self._version is not None:
+            self.version_checks += 1
+            if self._store.get_menu_version() == self._version:
+                self._loaded_at = time.monotonic()
+                return
+        self._load()
+
+    def _load(self):
+        # Version first: a sync landing in between is picked up next time
+        version = self._store.get_menu_version()
+        self._set(build_menu_prices(self._store.get_menu()))
+        self._version = version
+
+    def _set(self, prices):
+        self._prices = prices
+        self._loaded_at = time.monotonic()
+        self.refreshes += 1
+
+    def _start_listener(self):
+        try:
+            self._watch = self._store.watch_menu(self._on_menu)
+        except Exception as e:
+            logging.warning("Menu snapshot listener unavailable, using TTL refresh: %s", e)
+            self._watch = None
+        if self._watch is None:
+            self._listen = False
+
+    def _on_menu(self, menu):
+        # Runs on the listener thread; swapping the mapping is atomic
+        self._set(build_menu_prices(menu))
+
+
+def _active(watch):
+    # Firestore's Watch sets is_active to False once it gives up on the
+    # stream; handles without the attribute can't tell and count as active
+    return getattr(watch, "is_active", True)
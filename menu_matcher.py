@@ -0,0 +1,245 @@
+import re
+import functools
+from collections import Counter, defaultdict
+from itertools import chain, islice, product
+
+# Resolves what a customer said to a menu item when it isn't an exact
+# match: plurals ("pizzas"), other spellings ("chili paneer") and small
+# typos ("choclate shake"). MenuCache builds one per menu version.
+#
+# A lookup tries, in order:
+#   1. the name as given
+#   2. its canonical form: each word made singular and respelled via
+#      WORD_ALIASES
+#   3. the canonical form with each unknown word replaced by the menu words
+#      a single typo away from it (found through an index of every menu
+#      word with one letter deleted); if more than one such spelling is on
+#      the menu the query is ambiguous and nothing matches
+#   4. the letters re-split into menu words, for a space typed in the wrong
+#      place ("garlicbread", "garli cbread")
+#
+# Anything looser could charge for a different item ("masala dosa" is not
+# Masala Soda, "paneer pizza" is not Pizza), so it is only ever offered
+# back as a suggestion (suggest()) for the customer to confirm:
+#   - if every word is a menu word, the one item that has them all, for
+#     partial names like "lime soda"
+#   - otherwise the closest item by trigrams, if each word said is one of
+#     its words or close to one. The index lists the items containing each
+#     trigram; only items in the rarest lists are counted, and only the
+#     best few of those scored exactly, so a lookup never scans the menu.
+
+# Other spellings of menu words, keyed by their singular form
+WORD_ALIASES = {
+    "chili": "chilli",
+    "chilly": "chilli",
+    "maggie": "maggi",
+    "biriyani": "biryani",
+    "briyani": "biryani",
+    "pakora": "pakoda",
+    "milkshake": "shake",
+    "chip": "fry",
+}
+
+# Trigram similarity (Dice) a suggestion needs, and how far it has to be
+# ahead of the next item; "shake" alone shouldn't pick one of four shakes
+MIN_SCORE = 0.5
+MIN_MARGIN = 0.1
+# Similarity at which a word said counts as one of the item's words
+MIN_WORD_SCORE = 0.5
+
+# Postings counted per fuzzy lookup, rarest trigrams first, and how many
+# of the items found are scored exactly
+MAX_COUNTED_POSTINGS = 2000
+MAX_SCORED = 16
+
+# Shorter words aren't typo-corrected
+MIN_CORRECTED_LENGTH = 3
+# Spellings tried when several words of a query have more than one fix
+MAX_SPELLINGS = 32
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def normalize_item_name(name):
+    return str(name).strip().lower()
+
+
+def singular(word):
+    if len(word) <= 3 or word.endswith(("ss", "us")):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("ches", "shes", "sses", "xes", "zes", "oes")):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def canonical_word(word):
+    word = singular(word)
+    return WORD_ALIASES.get(word, word)
+
+
+def canonical(name):
+    return " ".join(map(canonical_word, _WORD.findall(name.lower())))
+
+
+def deletions(word):
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def within_one_edit(a, b):
+    # One insertion, deletion, substitution or swap of neighbours
+    if abs(len(a) - len(b)) > 1 or a == b:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    if a[i + 1:] == b[i + 1:]:
+        return True
+    return i + 1 < len(a) and a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:]
+
+
+def trigrams(phrase):
+    padded = f"  {phrase} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def dice(a, b):
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class MenuMatcher:
+    """Maps customer item names to normalized menu names."""
+
+    def __init__(self, names, aliases=None, cache_size=4096):
+        self._names = list(names)
+        phrases = [canonical(name) for name in self._names]
+        self._lookup = {name: name for name in self._names}
+        for name, phrase in zip(self._names, phrases):
+            self._lookup.setdefault(phrase, name)
+        for alias, name in (aliases or {}).items():
+            if name in self._lookup:
+                self._lookup[canonical(alias)] = name
+
+        self._words = set(chain.from_iterable(phrase.split() for phrase in phrases))
+        # Typos are corrected against the words as the menu spells them too,
+        # so "friees" finds "fries" even though its canonical form is "fry"
+        self._spelled = self._words.union(*(_WORD.findall(name.lower()) for name in self._names))
+        self._deletions = defaultdict(set)
+        for word in self._spelled:
+            if len(word) >= MIN_CORRECTED_LENGTH:
+                for variant in deletions(word):
+                    self._deletions[variant].add(word)
+        self._deletions = dict(self._deletions)
+
+        self._longest_word = max(map(len, self._words), default=0)
+
+        self._item_words = [frozenset(phrase.split()) for phrase in phrases]
+        self._word_items = defaultdict(set)
+        for i, words in enumerate(self._item_words):
+            for word in words:
+                self._word_items[word].add(i)
+        self._word_items = dict(self._word_items)
+
+        self._grams = [frozenset(trigrams(phrase)) for phrase in phrases]
+        postings = defaultdict(list)
+        for i, grams in enumerate(self._grams):
+            for gram in grams:
+                postings[gram].append(i)
+        self._index = dict(postings)
+
+        # Customers ask for the same few items over and over
+        self.match = functools.lru_cache(maxsize=cache_size)(self._match)
+        self.suggest = functools.lru_cache(maxsize=cache_size)(self._suggest)
+
+    def _match(self, query):
+        name = normalize_item_name(query)
+        found = self._lookup.get(name)
+        if found is not None:
+            return found
+        phrase = canonical(name)
+        found = self._lookup.get(phrase)
+        if found is not None or not phrase:
+            return found
+        spellings = product(*(self._spellings(word) for word in _WORD.findall(name)))
+        found = {self._lookup.get(" ".join(words)) for words in islice(spellings, MAX_SPELLINGS)}
+        found.discard(None)
+        if found:
+            return found.pop() if len(found) == 1 else None
+        return self._lookup.get(self._resplit(phrase.replace(" ", "")))
+
+    def _suggest(self, query):
+        # An item to ask the customer about when match() found none
+        phrase = canonical(normalize_item_name(query))
+        words = phrase.split()
+        if not words:
+            return None
+        if all(word in self._words for word in words):
+            items = set.intersection(*sorted((self._word_items[word] for word in words), key=len))
+            return self._names[items.pop()] if len(items) == 1 else None
+        found = self._fuzzy(trigrams(phrase))
+        if found is None or not all(self._has_word(found, word) for word in words):
+            return None
+        return self._names[found]
+
+    def _has_word(self, i, word):
+        if word in self._item_words[i]:
+            return True
+        grams = trigrams(word)
+        return any(dice(grams, trigrams(other)) >= MIN_WORD_SCORE for other in self._item_words[i])
+
+    def _spellings(self, word):
+        # Menu words the customer may have meant by word
+        canonical = canonical_word(word)
+        if canonical in self._words:
+            return (canonical,)
+        return tuple(self._corrections(canonical) | self._corrections(word)) or (canonical,)
+
+    def _corrections(self, word):
+        # Menu words one deletion, insertion, substitution or swap away
+        if len(word) < MIN_CORRECTED_LENGTH:
+            return set()
+        candidates = set(self._deletions.get(word, ()))
+        for variant in deletions(word):
+            if variant in self._spelled:
+                candidates.add(variant)
+            candidates.update(self._deletions.get(variant, ()))
+        return {canonical_word(candidate) for candidate in candidates if within_one_edit(word, candidate)}
+
+    def _resplit(self, letters):
+        # The fewest menu words that spell letters exactly
+        best = [None] * (len(letters) + 1)
+        best[0] = ()
+        for end in range(1, len(letters) + 1):
+            for start in range(max(0, end - self._longest_word), end):
+                if best[start] is not None and letters[start:end] in self._words:
+                    if best[end] is None or len(best[start]) + 1 < len(best[end]):
+                        best[end] = best[start] + (letters[start:end],)
+        return " ".join(best[-1]) if best[-1] else None
+
+    def _fuzzy(self, grams):
+        counted = 0
+        lists = []
+        for items in sorted((self._index[gram] for gram in grams if gram in self._index), key=len):
+            if counted + len(items) > MAX_COUNTED_POSTINGS and lists:
+                break
+            lists.append(items)
+            counted += len(items)
+        shortlist = Counter(chain.from_iterable(lists)).most_common(MAX_SCORED)
+
+        best, best_score, runner_up = None, 0.0, 0.0
+        for i, _ in shortlist:
+            score = dice(grams, self._grams[i])
+            if score > best_score:
+                best, best_score, runner_up = i, score, best_score
+            elif score > runner_up:
+                runner_up = score
+        if best is None or best_score < MIN_SCORE or best_score - runner_up < MIN_MARGIN:
+            return None
+        return best
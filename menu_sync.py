@@ -0,0 +1,104 @@
+import os
+import csv
+import json
+import argparse
+from storage import create_store
+
+# Brings the stored menu in line with a menu file. Only items that are new,
+# repriced or gone are written, in batches of up to 500, and the menu
+# version is bumped so running webhooks reload their prices.
+#
+#   python menu_sync.py menu.json              apply the changes
+#   python menu_sync.py menu.csv --dry-run     only list them
+#   python menu_sync.py menu.json --keep-missing
+#                                              don't delete items missing from the file
+#
+# JSON files hold {"Pizza": 400, ...} or [{"item": "Pizza", "price": 400}, ...];
+# CSV files need a header with item (or name) and price columns. The store
+# is chosen by ORDER_STORE as for the webhook.
+
+
+class MenuFileError(Exception):
+    pass
+
+
+def load_menu(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        if os.path.splitext(path)[1].lower() == ".csv":
+            rows = [(row.get("item") or row.get("name"), row.get("price")) for row in csv.DictReader(f)]
+        else:
+            data = json.load(f)
+            if isinstance(data, dict):
+                rows = list(data.items())
+            else:
+                rows = [(row.get("item") or row.get("name"), row.get("price")) for row in data]
+
+    menu = {}
+    for line, (item, price) in enumerate(rows, 1):
+        item = (item or "").strip()
+        if not item or "/" in item:
+            raise MenuFileError(f"Entry {line}: invalid item name {item!r}")
+        if item in menu:
+            raise MenuFileError(f"Entry {line}: {item!r} is listed twice")
+        menu[item] = _parse_price(item, price)
+    return menu
+
+
+def _parse_price(item, price):
+    try:
+        value = float(price)
+    except (TypeError, ValueError):
+        raise MenuFileError(f"Invalid price for {item!r}: {price!r}")
+    if not value > 0:
+        raise MenuFileError(f"Price for {item!r} must be positive: {price!r}")
+    return int(value) if value.is_integer() else value
+
+
+def diff_menu(current, desired, prune=True):
+    # (items to add or reprice, items to delete)
+    upserts = {item: price for item, price in desired.items() if current.get(item) != price}
+    removals = sorted(item for item in current if item not in desired) if prune else []
+    return upserts, removals
+
+
+def sync_menu(store, desired, prune=True, dry_run=False):
+    # Returns (upserts, removals, new version); the version is None when
+    # nothing was written
+    upserts, removals = diff_menu(store.get_menu(), desired, prune)
+    if dry_run or not (upserts or removals):
+        return upserts, removals, None
+    return upserts, removals, store.sync_menu(upserts, removals)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync the stored menu with a JSON or CSV menu file.")
+    parser.add_argument("path")
+    parser.add_argument("--dry-run", action="store_true", help="list the changes without writing them")
+    parser.add_argument("--keep-missing", action="store_true", help="don't delete items missing from the file")
+    args = parser.parse_args(argv)
+
+    try:
+        desired = load_menu(args.path)
+    except (OSError, ValueError, MenuFileError) as e:
+        parser.exit(1, f"Error reading {args.path}: {e}\n")
+
+    store = create_store()
+    try:
+        upserts, removals, version = sync_menu(store, desired, not args.keep_missing, args.dry_run)
+    finally:
+        store.close()
+
+    for item, price in sorted(upserts.items()):
+        print(f"  set     {item}: {price}")
+    for item in removals:
+        print(f"  remove  {item}")
+    if args.dry_run:
+        print(f"Dry run: {len(upserts)} items to set, {len(removals)} to remove.")
+    elif version is None:
+        print("Menu already up to date.")
+    else:
+        print(f"Menu synced: {len(upserts)} items set, {len(removals)} removed, now version {version}.")
+
+
+if __name__ == "__main__":
+    main()
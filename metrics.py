@@ -0,0 +1,456 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import logging
+import threading
+from fulfillment import ADD_TO_ORDER_INTENT, PLACE_ORDER_INTENT, REMOVE_FROM_ORDER_INTENT, reply_outcome
+from circuit_breaker import STATES
+import storage
+from storage import AsyncStoreWrapper, StoreWrapper
+
+# Prometheus metrics for the webhooks, served as text at /metrics.
+#
+# Recording takes no locks: each thread updates its own shard of a metric
+# and a scrape adds the shards up. Gunicorn workers are separate processes,
+# so to see all of them from any one scrape set METRICS_DIR to a directory
+# they share; every worker writes its totals there each
+# METRICS_FLUSH_INTERVAL seconds (default 5) and on exit, and a scrape merges
+# the files with its own live numbers.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _reset(self):
+        self._local = threading.local()
+        self._shards = []
+
+    def collect(self):
+        # {label values: value} summed over every thread's shard
+        raise NotImplementedError
+
+    def merge(self, totals, value):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self):
+        totals = {}
+        for shard in list(self._shards):
+            for labels, value in shard.copy().items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def merge(self, current, value):
+        return (current or 0) + value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        # Per label set: one count per bucket, then +Inf, then the sum
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        totals = {}
+        for shard in list(self._shards):
+            for labels, counts in shard.copy().items():
+                totals[labels] = self.merge(totals.get(labels), counts)
+        return totals
+
+    def merge(self, current, value):
+        if current is None:
+            return list(value)
+        return [a + b for a, b in zip(current, value)]
+
+
+class CallbackMetric(Metric):
+    # Read from a function at scrape time, for values something else
+    # already keeps (cache stats, breaker state)
+
+    def __init__(self, name, documentation, labels, callback, kind="gauge"):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self._callback = callback
+
+    def collect(self):
+        return dict(self._callback())
+
+    def merge(self, current, value):
+        return (current or 0) + value
+
+
+class Registry:
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._metrics = []
+
+    def register(self, metric):
+        # Re-registering a name replaces it (e.g. app.py and asgi.py loaded together)
+        self._metrics = [existing for existing in self._metrics if existing.name != metric.name]
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def callback(self, name, documentation, callback, labels=(), kind="gauge"):
+        return self.register(CallbackMetric(name, documentation, labels, callback, kind))
+
+    def collect(self):
+        # Gauges from different workers can't be added up, so with
+        # METRICS_DIR they are reported per worker instead
+        per_worker = self.directory is not None
+        snapshots = [(os.getpid(), self.snapshot())]
+        if per_worker:
+            snapshots.extend(self._read_workers())
+
+        totals = {}
+        for pid, snapshot in snapshots:
+            for metric in self._metrics:
+                merged = totals.setdefault(metric.name, {})
+                for labels, value in snapshot.get(metric.name, ()):
+                    labels = tuple(labels)
+                    if metric.kind == "gauge":
+                        if not per_worker:
+                            merged[labels] = value
+                        elif pid == os.getpid() or _alive(pid):
+                            merged[labels + (str(pid),)] = value
+                    else:
+                        merged[labels] = metric.merge(merged.get(labels), value)
+        return totals
+
+    def snapshot(self):
+        return {
+            metric.name: [[list(labels), value] for labels, value in metric.collect().items()]
+            for metric in self._metrics
+        }
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            names = metric.labels
+            if metric.kind == "gauge" and self.directory is not None:
+                names += ("worker",)
+            for labels, value in sorted(totals[metric.name].items()):
+                pairs = list(zip(names, labels))
+                if metric.kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), value):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{metric.name}_bucket{_labels(pairs + [('le', le)])} {cumulative}")
+                    lines.append(f"{metric.name}_sum{_labels(pairs)} {_number(value[-1])}")
+                    lines.append(f"{metric.name}_count{_labels(pairs)} {cumulative}")
+                else:
+                    lines.append(f"{metric.name}{_labels(pairs)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        # Write this worker's totals for the others to merge; skipped until
+        # something has been recorded so the gunicorn master stays out
+        if self.directory is None or not any(metric._shards for metric in self._metrics):
+            return
+        path = os.path.join(self.directory, f"worker-{os.getpid()}.json")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as out:
+                json.dump(self.snapshot(), out)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning("Failed to write metrics to %s: %s", path, e)
+
+    def _read_workers(self):
+        own = f"worker-{os.getpid()}.json"
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        snapshots = []
+        for name in names:
+            if not (name.startswith("worker-") and name.endswith(".json")) or name == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as snapshot:
+                    snapshots.append((int(name[7:-5]), json.load(snapshot)))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+registry = Registry(os.environ.get("METRICS_DIR") or None)
+
+# Webhook -------------------------------------------------------------------
+
+webhook_requests = registry.counter(
+    "webhook_requests_total", "Webhook requests by intent.", ("intent",))
+webhook_duration = registry.histogram(
+    "webhook_request_duration_seconds", "Webhook handling time by intent.", ("intent",))
+webhook_replies = registry.counter(
+    "webhook_replies_total", "Webhook replies by intent and outcome; anything but ok is an error.", ("intent", "outcome"))
+
+INTENTS = frozenset((PLACE_ORDER_INTENT, ADD_TO_ORDER_INTENT, REMOVE_FROM_ORDER_INTENT))
+
+
+def observe_webhook(intent, reply, seconds):
+    # Intent names come from the request; keep unknown ones out of the labels
+    intent = intent if intent in INTENTS else ("other" if intent else "none")
+    labels = (intent,)
+    webhook_requests.inc(labels)
+    webhook_duration.observe(labels, seconds)
+    webhook_replies.inc((intent, reply_outcome(reply.get("fulfillmentText", ""))))
+
+
+handler_duration = registry.histogram(
+    "intent_handler_duration_seconds", "Intent handler time, without replayed replies.", ("intent",))
+
+
+def time_handler(req, handler):
+    # intent_router middleware
+    start = time.perf_counter()
+    try:
+        return handler(req)
+    finally:
+        handler_duration.observe((req.intent,), time.perf_counter() - start)
+
+
+async def time_handler_async(req, handler):
+    start = time.perf_counter()
+    try:
+        return await handler(req)
+    finally:
+        handler_duration.observe((req.intent,), time.perf_counter() - start)
+
+
+def register_router(router):
+    # After the handlers are registered: their intents become labels
+    global INTENTS
+    INTENTS = INTENTS | frozenset(router.intents())
+    registry.callback("intent_in_flight", "Requests being handled, by intent.",
+                      lambda: {(intent,): stats["in_flight"] for intent, stats in router.stats().items()}, labels=("intent",))
+    registry.callback("intent_concurrency_limit", "Requests an intent may handle at once (0 for no limit).",
+                      lambda: {(intent,): stats["limit"] for intent, stats in router.stats().items()}, labels=("intent",))
+    registry.callback("intent_busy_total", "Requests turned away because their intent was at its limit.",
+                      lambda: {(intent,): stats["busy"] for intent, stats in router.stats().items()},
+                      labels=("intent",), kind="counter")
+
+
+def register_menu_cache(menu_cache):
+    registry.callback("menu_cache_hits_total", "Menu lookups served from the cache.",
+                      lambda: {(): menu_cache.hits}, kind="counter")
+    registry.callback("menu_cache_misses_total", "Menu lookups that had to load the menu.",
+                      lambda: {(): menu_cache.misses}, kind="counter")
+    registry.callback("menu_cache_version_checks_total", "Menu version reads made when the cached menu expired.",
+                      lambda: {(): menu_cache.version_checks}, kind="counter")
+    registry.callback("menu_cache_items", "Items in the cached menu.",
+                      lambda: {(): menu_cache.stats()["items"]})
+
+
+def register_response_cache(response_cache):
+    registry.callback("idempotent_replays_total", "Retried webhook calls answered with the first call's reply.",
+                      lambda: {(): response_cache.hits}, kind="counter")
+    registry.callback("idempotent_waits_total", "Retried webhook calls that waited for the first call to finish.",
+                      lambda: {(): response_cache.waits}, kind="counter")
+    registry.callback("idempotent_evictions_total", "Replies dropped from the full response cache.",
+                      lambda: {(): response_cache.evictions}, kind="counter")
+    registry.callback("idempotent_cached_replies", "Replies in the response cache.",
+                      lambda: {(): response_cache.stats()["entries"]})
+
+
+def register_order_cache(order_cache):
+    registry.callback("order_cache_hits_total", "Order changes worked out from a cached copy instead of a read.",
+                      lambda: {(): order_cache.hits}, kind="counter")
+    registry.callback("order_cache_misses_total", "Order changes that had to read the order first.",
+                      lambda: {(): order_cache.misses}, kind="counter")
+    registry.callback("order_cache_stale_total", "Conditional order writes refused because the cached copy was out of date.",
+                      lambda: {(): order_cache.stale}, kind="counter")
+    registry.callback("order_cache_evictions_total", "Orders dropped from the full order cache.",
+                      lambda: {(): order_cache.evictions}, kind="counter")
+    registry.callback("order_cache_orders", "Orders in the order cache.",
+                      lambda: {(): order_cache.stats()["entries"]})
+
+
+def register_write_behind(store):
+    registry.callback("write_behind_batches_total", "Group commits of order writes.",
+                      lambda: {(): store.batches}, kind="counter")
+    registry.callback("write_behind_writes_total", "Order writes committed in groups.",
+                      lambda: {(): store.writes}, kind="counter")
+    registry.callback("write_behind_rejected_total", "Order writes refused because the queue was full.",
+                      lambda: {(): store.rejected}, kind="counter")
+    registry.callback("write_behind_queued", "Order writes waiting to commit.",
+                      lambda: {(): store.stats()["queued"]})
+
+
+def register_breaker(breaker):
+    registry.callback("store_breaker_state", "Store circuit breaker state; 1 for the current one.",
+                      lambda: {(state,): int(breaker.state == state) for state in STATES}, labels=("state",))
+    registry.callback("store_breaker_opens_total", "Times the store circuit breaker opened.",
+                      lambda: {(): breaker.opens}, kind="counter")
+    registry.callback("store_breaker_rejected_total", "Store calls refused while the circuit breaker was open.",
+                      lambda: {(): breaker.rejected}, kind="counter")
+
+
+def register_deferred_writes(deferred):
+    registry.callback("deferred_orders_saved_total", "Orders taken while the store was down and saved later.",
+                      lambda: {(): deferred.saved}, kind="counter")
+    registry.callback("deferred_orders_refused_total", "Orders refused because the deferred queue was full.",
+                      lambda: {(): deferred.refused}, kind="counter")
+    registry.callback("deferred_orders_queued", "Orders waiting for the store to come back.",
+                      lambda: {(): deferred.stats()["queued"]})
+
+
+# Store ---------------------------------------------------------------------
+
+store_calls = registry.counter(
+    "store_calls_total", "Order store method calls by operation.", ("operation",))
+store_duration = registry.histogram(
+    "store_call_duration_seconds", "Order store call time by operation.", ("operation",))
+store_errors = registry.counter(
+    "store_call_errors_total", "Order store calls that raised, by exception type.", ("operation", "error"))
+# One store call can be any number of round trips (mutate_order may be a
+# conditional write alone, a read and a write, retries, or a transaction),
+# so the Firestore stores report each one as it happens
+store_rpcs = registry.counter(
+    "store_rpcs_total", "Firestore round trips by operation and kind (read, write, conditional_write "
+    "or transaction attempt).", ("operation", "kind"))
+
+
+def _observe_store(operation, start, error=None):
+    labels = (operation,)
+    store_calls.inc(labels)
+    store_duration.observe(labels, time.perf_counter() - start)
+    if error is not None:
+        store_errors.inc((operation, type(error).__name__))
+
+
+def _observe_rpc(operation, kind):
+    store_rpcs.inc((operation, kind))
+
+
+storage.rpc_observer = _observe_rpc
+
+
+class InstrumentedStore(StoreWrapper):
+    # Records every call to the wrapped store
+
+    def _call(self, operation, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = getattr(self._store, operation)(*args, **kwargs)
+        except Exception as e:
+            _observe_store(operation, start, e)
+            raise
+        _observe_store(operation, start)
+        return result
+
+
+class InstrumentedAsyncStore(AsyncStoreWrapper):
+    def __init__(self, store):
+        super().__init__(store)
+        self.menu_store = InstrumentedStore(store.menu_store)
+
+    async def _call(self, operation, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await getattr(self._store, operation)(*args, **kwargs)
+        except Exception as e:
+            _observe_store(operation, start, e)
+            raise
+        _observe_store(operation, start)
+        return result
+
+
+# Worker snapshots ----------------------------------------------------------
+
+def _flush_periodically(interval):
+    while True:
+        time.sleep(interval)
+        registry.flush()
+
+
+def _start_flusher():
+    if registry.directory is not None:
+        interval = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+        threading.Thread(target=_flush_periodically, args=(interval,), name="metrics-flush", daemon=True).start()
+
+
+def _after_fork():
+    # Start each worker from zero with its own flush thread
+    for metric in registry._metrics:
+        metric._reset()
+    _start_flusher()
+
+
+_start_flusher()
+atexit.register(registry.flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
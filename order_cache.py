@@ -0,0 +1,81 @@
+import os
+import copy
+import threading
+from collections import OrderedDict
+
+# Recently touched orders, each with the update time Firestore gave it. A
+# customer usually sends several add/remove intents for one order within a
+# minute; FirestoreStore works out a change from the cached copy and writes
+# it on condition that the order's update time still matches, so the
+# common case skips the read. If someone else changed the order in the
+# meantime the write fails, the copy is dropped and the store reads afresh.
+# Because every write is conditional, a stale copy costs a retry, never a
+# lost update.
+#
+#   ORDER_CACHE_SIZE   orders kept per process (default 1000, 0 to turn off)
+
+
+class OrderCache:
+    def __init__(self, max_entries=None):
+        self._max_entries = int(max_entries if max_entries is not None else os.environ.get("ORDER_CACHE_SIZE", 1000))
+        self._lock = threading.Lock()
+        self._orders = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, order_id):
+        # (copy of the order, update time), or None
+        with self._lock:
+            entry = self._orders.get(order_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._orders.move_to_end(order_id)
+            self.hits += 1
+        return copy.deepcopy(entry[0]), entry[1]
+
+    def peek(self, order_ids):
+        # {order_id: (order, update time)} for the cached ones; the orders
+        # are the cached objects themselves and must not be changed
+        with self._lock:
+            return {order_id: self._orders[order_id] for order_id in order_ids if order_id in self._orders}
+
+    def put(self, order_id, order, update_time):
+        if self._max_entries <= 0:
+            return
+        order = copy.deepcopy(order)
+        with self._lock:
+            entry = self._orders.get(order_id)
+            # Writes from concurrent requests can finish out of order
+            if entry is not None and entry[1] > update_time:
+                return
+            self._orders[order_id] = (order, update_time)
+            self._orders.move_to_end(order_id)
+            while len(self._orders) > self._max_entries:
+                self._orders.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, order_id):
+        with self._lock:
+            self._orders.pop(order_id, None)
+
+    def mark_stale(self, order_id):
+        # A conditional write found the cached copy out of date
+        with self._lock:
+            self.stale += 1
+            self._orders.pop(order_id, None)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "entries": len(self._orders),
+        }
+
+
+# Shared by every Firestore store in the process
+order_cache = OrderCache()
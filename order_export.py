@@ -0,0 +1,146 @@
+import io
+import os
+import csv
+import logging
+from datetime import date, datetime, time, timedelta
+import dialogflow
+from order_ids import id_bounds, normalize_order_id
+from order_model import OrderItems
+
+# Order history export for ops (GET /orders in app.py and asgi.py),
+# streamed as NDJSON or CSV. Orders are read a page at a time in order ID
+# order, and each page is encoded and sent before the next is read, so
+# memory stays the same however many orders match. Order IDs start with
+# their creation time (see order_ids.py), so a date range is an ID range
+# and the store needs no index beyond the document ID.
+#
+# Query parameters:
+#   format   ndjson (default) or csv
+#   from     first day, YYYY-MM-DD, in the server's local time
+#   to       last day, inclusive; with only from, runs up to now
+#   after    order ID to resume after, e.g. the last one of a cut-off export
+#   limit    most orders to send
+#
+# Orders whose IDs predate the time-ordered format come last in a full
+# export and are left out of date ranges.
+#
+#   EXPORT_PAGE_SIZE   orders read per store call (default 500)
+
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+CSV_COLUMNS = ("order_id", "timestamp", "total_amount", "items")
+
+
+class ExportQuery:
+    __slots__ = ("format", "after", "before", "limit")
+
+    def __init__(self, format="ndjson", after=None, before=None, limit=None):
+        self.format = format
+        self.after = after
+        self.before = before
+        self.limit = limit
+
+    @classmethod
+    def from_args(cls, args):
+        # args maps parameter names to strings; raises ValueError with a
+        # message for the client
+        format = args.get("format") or "ndjson"
+        if format not in CONTENT_TYPES:
+            raise ValueError("format must be ndjson or csv")
+        try:
+            first = date.fromisoformat(args["from"]) if args.get("from") else None
+            last = date.fromisoformat(args["to"]) if args.get("to") else None
+        except ValueError:
+            raise ValueError("from and to must be YYYY-MM-DD")
+        if first is not None and last is not None and last < first:
+            raise ValueError("to must not be before from")
+        limit = args.get("limit")
+        if limit is not None:
+            if not limit.isdecimal() or int(limit) == 0:
+                raise ValueError("limit must be a positive integer")
+            limit = int(limit)
+
+        after = before = None
+        if first is not None or last is not None:
+            after, before = id_bounds(
+                _local_midnight(first) if first is not None else None,
+                _local_midnight(last + timedelta(days=1)) if last is not None else datetime.now().astimezone(),
+            )
+        if args.get("after"):
+            cursor = normalize_order_id(args["after"])
+            after = cursor if after is None else max(after, cursor)
+        return cls(format, after, before, limit)
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+    @property
+    def filename(self):
+        return f"orders.{self.format}"
+
+
+def pages(store, query, page_size=None):
+    # Lists of (order_id, order), read one store call at a time
+    page_size = int(page_size if page_size is not None else os.environ.get("EXPORT_PAGE_SIZE", 500))
+    after, remaining = query.after, query.limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        page = store.list_orders(after, query.before, size)
+        if page:
+            yield page
+        if len(page) < size:
+            return
+        after = page[-1][0]
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def export_chunks(store, query, page_size=None):
+    # Encoded chunks, one per page; the first is read from the store even
+    # when no orders match, so callers can take it before sending headers
+    # and still answer store errors with a status
+    encode = _encode_csv if query.format == "csv" else _encode_ndjson
+    first = True
+    sent = 0
+    last_id = query.after
+    try:
+        for page in pages(store, query, page_size):
+            yield encode(page, first)
+            first = False
+            sent += len(page)
+            last_id = page[-1][0]
+    except Exception as e:
+        logging.error("Order export failed: %s", e, extra={"orders_sent": sent, "last_order_id": last_id})
+        raise
+    if first:
+        yield encode((), True)
+
+
+def order_row(order_id, order):
+    # Lines from the items map and legacy orderItems lists alike
+    return {
+        "orderId": order_id,
+        "timestamp": order.get("timestamp"),
+        "totalAmount": order.get("totalAmount", 0),
+        "items": [line.to_dict() for line in OrderItems.from_order(order).lines.values()],
+    }
+
+
+def _encode_ndjson(page, first):
+    return b"".join(dialogflow.dumps(order_row(order_id, order)) + b"\n" for order_id, order in page)
+
+
+def _encode_csv(page, first):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if first:
+        writer.writerow(CSV_COLUMNS)
+    for order_id, order in page:
+        row = order_row(order_id, order)
+        items = "; ".join(f"{line['quantity']} x {line['item']}" for line in row["items"])
+        writer.writerow((order_id, row["timestamp"] or "", row["totalAmount"], items))
+    return buffer.getvalue().encode()
+
+
+def _local_midnight(day):
+    return datetime.combine(day, time.min).astimezone()
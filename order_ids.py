@@ -0,0 +1,149 @@
+import os
+import time
+import secrets
+import threading
+
+# Crockford base32: no I, L, O or U, so IDs survive being read back aloud,
+# and the alphabet is in ASCII order so encoded IDs sort like the integers.
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_DECODE_ALIASES = str.maketrans({"O": "0", "I": "1", "L": "1"})
+
+PREFIX = "order_"
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+
+TIMESTAMP_BITS = 41
+NODE_BITS = 10  # HOST_BITS for the dyno, WORKER_BITS for the process on it
+HOST_BITS = 6
+WORKER_BITS = NODE_BITS - HOST_BITS
+SEQUENCE_BITS = 12
+ID_LENGTH = 13  # ceil(63 / 5) base32 characters
+
+MAX_HOST = (1 << HOST_BITS) - 1
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class OrderIdGenerator:
+    """Snowflake-style order IDs: 41-bit millisecond timestamp, 10-bit node,
+    12-bit sequence, rendered as 13 Crockford base32 characters.
+
+    The node is a 6-bit host number (ORDER_ID_NODE, one per dyno; drawn at
+    random when unset) and a 4-bit worker slot. gunicorn.conf.py gives each
+    live worker its own slot in post_fork; other forked processes fall
+    back to their pid. IDs are unique as long as no two processes share
+    both, and are strictly increasing within a process, even if the wall
+    clock steps backwards or more than 4096 IDs are taken in one
+    millisecond: the generator then runs ahead on its own counter instead
+    of blocking.
+    """
+
+    def __init__(self, host=None, worker=0):
+        self.host = _resolve_host(host)
+        self.worker = _check_worker(worker)
+        self._lock = threading.Lock()
+        self._last = 0
+
+    @property
+    def node(self):
+        return (self.host << WORKER_BITS) | self.worker
+
+    def reseed(self):
+        # After fork: the child must not share the parent's node. The host
+        # stays, so every process on a dyno keeps its ORDER_ID_NODE (or
+        # random host) and only the worker part differs.
+        self.set_worker(os.getpid() & MAX_WORKER)
+
+    def set_worker(self, worker):
+        with self._lock:
+            self.worker = _check_worker(worker)
+            self._last = 0
+
+    def next_int(self):
+        now = (time.time_ns() // 1000000 - EPOCH_MS) << (NODE_BITS + SEQUENCE_BITS)
+        with self._lock:
+            last = self._last
+            if now > last:
+                value = now
+            elif last & MAX_SEQUENCE < MAX_SEQUENCE:
+                # Same millisecond, or the clock went back: next sequence
+                value = last + 1
+            else:
+                # Sequence exhausted: carry into the next millisecond
+                value = (last & ~MAX_SEQUENCE) + (1 << (NODE_BITS + SEQUENCE_BITS))
+            self._last = value
+            node = self.node
+        return value | (node << SEQUENCE_BITS)
+
+    def next_id(self):
+        return PREFIX + encode(self.next_int())
+
+
+# Two characters per 10-bit chunk keeps encoding to a handful of lookups
+_PAIRS = [ALPHABET[i >> 5] + ALPHABET[i & 31] for i in range(1 << 10)]
+
+
+def encode(value):
+    return (
+        ALPHABET[(value >> 60) & 31]
+        + _PAIRS[(value >> 50) & 1023]
+        + _PAIRS[(value >> 40) & 1023]
+        + _PAIRS[(value >> 30) & 1023]
+        + _PAIRS[(value >> 20) & 1023]
+        + _PAIRS[(value >> 10) & 1023]
+        + _PAIRS[value & 1023]
+    )
+
+
+def id_bounds(start=None, end=None):
+    # Exclusive (after, before) order IDs around the orders generated from
+    # start up to end (aware datetimes, None for no bound)
+    after = before = None
+    if start is not None:
+        value = _id_value_at(start)
+        after = PREFIX + encode(value - 1) if value > 0 else None
+    if end is not None:
+        before = PREFIX + encode(_id_value_at(end))
+    return after, before
+
+
+def _id_value_at(moment):
+    # Smallest ID value that can be generated at moment
+    ms = min(max(int(moment.timestamp() * 1000) - EPOCH_MS, 0), (1 << TIMESTAMP_BITS) - 1)
+    return ms << (NODE_BITS + SEQUENCE_BITS)
+
+
+def normalize_order_id(order_id):
+    # Accept IDs as customers type or say them back: any case, with
+    # O/I/L misread for 0/1/1, with or without the "order_" prefix.
+    order_id = str(order_id).strip()
+    suffix = order_id[len(PREFIX):] if order_id.lower().startswith(PREFIX) else order_id
+    if len(suffix) == ID_LENGTH:
+        return PREFIX + suffix.upper().translate(_DECODE_ALIASES)
+    return order_id
+
+
+def _resolve_host(host):
+    if host is None:
+        host = os.environ.get("ORDER_ID_NODE")
+    if host is None:
+        return secrets.randbits(HOST_BITS)
+    host = int(host)
+    if not 0 <= host <= MAX_HOST:
+        raise ValueError(f"ORDER_ID_NODE must be between 0 and {MAX_HOST}, got {host}")
+    return host
+
+
+def _check_worker(worker):
+    if not 0 <= worker <= MAX_WORKER:
+        raise ValueError(f"Order ID worker slot must be between 0 and {MAX_WORKER}, got {worker}")
+    return worker
+
+
+order_ids = OrderIdGenerator()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=order_ids.reseed)
+
+
+def new_order_id():
+    return order_ids.next_id()
@@ -0,0 +1,83 @@
+from menu_cache import normalize_item_name
+
+
+class OrderLine:
+    __slots__ = ("item", "quantity")
+
+    def __init__(self, item, quantity):
+        self.item = item
+        self.quantity = quantity
+
+    def to_dict(self):
+        return {"item": self.item, "quantity": self.quantity}
+
+    def __repr__(self):
+        return f"OrderLine({self.item!r}, {self.quantity!r})"
+
+
+class OrderItems:
+    """Order lines keyed by normalized item name.
+
+    Stored on the order document as an ``items`` map of
+    ``{normalized name: {"item": display name, "quantity": n}}``. Documents
+    written before the map existed keep a list under ``orderItems``; those
+    lines are folded in when the order is loaded, and the next full write
+    (see ``to_fields``) drops the legacy list.
+    """
+
+    __slots__ = ("lines", "legacy")
+
+    def __init__(self, lines=None, legacy=False):
+        self.lines = lines if lines is not None else {}
+        self.legacy = legacy
+
+    @classmethod
+    def from_order(cls, order):
+        order_items = cls()
+        for key, line in (order.get("items") or {}).items():
+            order_items.lines[key] = OrderLine(line.get("item", key), line.get("quantity", 0))
+
+        # Lazy migration of list-shaped orders
+        legacy_lines = order.get("orderItems")
+        if legacy_lines:
+            order_items.legacy = True
+            for line in legacy_lines:
+                order_items.add(line["item"], line["quantity"])
+        elif legacy_lines is not None:
+            order_items.legacy = True
+        return order_items
+
+    def add(self, item, quantity):
+        key = normalize_item_name(item)
+        line = self.lines.get(key)
+        if line is None:
+            self.lines[key] = OrderLine(item, quantity)
+        else:
+            line.quantity += quantity
+        return key
+
+    def get(self, item):
+        return self.lines.get(normalize_item_name(item))
+
+    def remove(self, key, quantity):
+        line = self.lines[key]
+        line.quantity -= quantity
+        if line.quantity <= 0:
+            del self.lines[key]
+
+    def to_firestore(self):
+        return {key: line.to_dict() for key, line in self.lines.items() if line.quantity > 0}
+
+    def to_fields(self, delete_field):
+        # Fields for a full rewrite of the lines; delete_field is the store's
+        # sentinel for removing the legacy list.
+        fields = {"items": self.to_firestore()}
+        if self.legacy:
+            fields["orderItems"] = delete_field
+        return fields
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
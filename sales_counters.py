@@ -0,0 +1,86 @@
+import os
+import random
+from datetime import date
+from order_model import OrderItems
+
+# Running sales totals, so "today's revenue" or "pizzas sold today" is a
+# read of a few counter documents instead of a scan of every order. Each
+# day's totals are spread over SALES_SHARDS documents and every order
+# change adds to one of them at random, in the same commit as the order
+# itself, so no single document takes every write. totals() adds the
+# shards back up.
+#
+# A shard holds orders (orders placed), revenue, and items.<name>
+# (quantity, keyed by normalized item name). Changes count towards the
+# day they are made on, in the server's local time.
+#
+#   SALES_SHARDS     counter documents per day (default 10); raising it is
+#                    safe, lowering it hides the dropped shards from totals()
+#   SALES_COUNTERS   0 to stop recording
+
+ORDERS = ("orders",)
+REVENUE = ("revenue",)
+
+
+def counter_id(day, shard):
+    return f"sales-{day.isoformat()}-{shard}"
+
+
+class SalesCounters:
+    def __init__(self, shards=None, enabled=None):
+        self.shards = int(shards if shards is not None else os.environ.get("SALES_SHARDS", 10))
+        if enabled is None:
+            enabled = os.environ.get("SALES_COUNTERS", "1") != "0"
+        self.enabled = enabled
+
+    def placed(self, order_items, amount):
+        # Counter writes to commit with a new order
+        return self._writes(_quantities(order_items.lines), amount, orders=1)
+
+    def added(self, order_items, amount):
+        # Counter writes to commit with items added to an order
+        return self._writes(_quantities(order_items.lines), amount)
+
+    def changed(self, order, fields):
+        # Counter writes for a mutate_order change, from the order as read
+        # and the fields written over it
+        if "items" not in fields:
+            return []
+        before = _quantities(OrderItems.from_order(order).lines)
+        after = {key: line.get("quantity", 0) for key, line in fields["items"].items()}
+        quantities = {key: after.get(key, 0) - before.get(key, 0) for key in before.keys() | after.keys()}
+        amount = fields.get("totalAmount", 0) - order.get("totalAmount", 0)
+        return self._writes(quantities, amount)
+
+    def totals(self, store, day=None):
+        # Sales for day (default today), merged from its shards
+        day = day or date.today()
+        shards = store.get_counters([counter_id(day, shard) for shard in range(self.shards)])
+        orders = revenue = 0
+        items = {}
+        for counter in shards.values():
+            orders += counter.get("orders", 0)
+            revenue += counter.get("revenue", 0)
+            for item, quantity in (counter.get("items") or {}).items():
+                items[item] = items.get(item, 0) + quantity
+        return {
+            "day": day.isoformat(),
+            "orders": orders,
+            "revenue": revenue,
+            # Best sellers first
+            "items": dict(sorted(((item, n) for item, n in items.items() if n), key=lambda entry: -entry[1])),
+        }
+
+    def _writes(self, quantities, amount, orders=0):
+        increments = {("items", key): quantity for key, quantity in quantities.items() if quantity}
+        if amount:
+            increments[REVENUE] = amount
+        if orders:
+            increments[ORDERS] = orders
+        if not self.enabled or not increments:
+            return []
+        return [("count", counter_id(date.today(), random.randrange(self.shards)), increments)]
+
+
+def _quantities(lines):
+    return {key: line.quantity for key, line in lines.items()}
@@ -0,0 +1,1232 @@
+import os
+import copy
+import heapq
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from deadlines import call_timeout
+from order_cache import order_cache as default_order_cache
+
+
+class _DeleteField:
+    def __repr__(self):
+        return "DELETE_FIELD"
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+# Field value that removes the field in update_order/mutate_order
+DELETE_FIELD = _DeleteField()
+
+# Writes Firestore accepts in one batch
+MAX_FIRESTORE_BATCH = 500
+
+# Conditional writes mutate_order tries before falling back to a transaction
+CONDITIONAL_ATTEMPTS = 3
+
+# Called as rpc_observer(operation, kind) for each round trip the Firestore
+# stores make, whichever path a method takes; kind is "read", "write",
+# "conditional_write" (applies only if the order is unchanged since it was
+# cached) or "transaction" (one per attempt). metrics.py sets it.
+rpc_observer = None
+
+
+class OrderNotFound(Exception):
+    pass
+
+
+class OrderExists(Exception):
+    # A "create" write found the order ID already taken
+    pass
+
+
+class OrderRejected(Exception):
+    # Raised from a mutate_order callback to abort the change; the message
+    # is meant for the customer.
+    pass
+
+
+class OrderStore:
+    """Backend used by the webhook for orders and the menu.
+
+    Orders are plain dicts keyed by order ID; the menu is a mapping of item
+    name to price exactly as stored (normalization is left to the caller).
+    """
+
+    def get_order(self, order_id):
+        raise NotImplementedError
+
+    def set_order(self, order_id, order):
+        raise NotImplementedError
+
+    def update_order(self, order_id, fields):
+        raise NotImplementedError
+
+    def mutate_order(self, order_id, mutate, writes=None):
+        # Atomically read the order, pass it to mutate() and apply the
+        # top-level fields it returns. mutate() may run more than once and
+        # must not have side effects; raises OrderNotFound if the order does
+        # not exist. writes(order, fields), if given, returns counter writes
+        # (see commit_writes) to commit in the same transaction.
+        raise NotImplementedError
+
+    def increment_order(self, order_id, increments, fields=None):
+        # One atomic write without a read: add each delta in increments to
+        # its field and set fields. Keys are field paths as tuples. Returns
+        # {path: new value} for the incremented fields; raises OrderNotFound
+        # if the order does not exist.
+        raise NotImplementedError
+
+    def commit_writes(self, writes):
+        # Commits ("create", order_id, order), ("set", order_id, order),
+        # ("increment", order_id, increments, fields) and ("count",
+        # counter_id, increments) writes together, all or nothing where the
+        # backend allows, and returns each one's result (the new values for
+        # an order increment, else None). No order or counter appears twice;
+        # raises OrderExists if a created order already exists and
+        # OrderNotFound if an incremented one does not.
+        return [_apply_write(self, write) for write in writes]
+
+    def list_orders(self, after=None, before=None, limit=100):
+        # One page of (order_id, order) pairs in order ID order, with IDs
+        # between after and before (both exclusive, None for no bound); the
+        # next page starts after the last ID returned
+        raise NotImplementedError
+
+    def increment_counter(self, counter_id, increments):
+        # Adds each delta to its field of the counter document, creating
+        # the document if needed; keys are field paths as tuples
+        raise NotImplementedError
+
+    def get_counters(self, counter_ids):
+        # {counter_id: fields} for those of counter_ids that exist
+        raise NotImplementedError
+
+    def get_menu(self):
+        raise NotImplementedError
+
+    def watch_menu(self, callback):
+        # Backends that can push menu changes return a handle with
+        # unsubscribe(); the rest return None and callers fall back to polling.
+        return None
+
+    def get_menu_version(self):
+        # Number bumped by every sync_menu, so pollers can tell whether the
+        # menu changed without reading it; None if the menu was never synced
+        return None
+
+    def sync_menu(self, upserts, removals):
+        # Sets the price of each item in upserts, deletes the items in
+        # removals, then bumps the menu version; returns the new version
+        raise NotImplementedError
+
+    def claim_response(self, key, ttl):
+        # Idempotency record for one webhook request (see idempotency.py).
+        # Atomically creates an empty record that lives ttl seconds and
+        # returns None, or returns the live record someone else created:
+        # {"reply": ...} once their request finished, {} while it runs.
+        raise NotImplementedError
+
+    def save_response(self, key, reply, ttl):
+        raise NotImplementedError
+
+    def release_response(self, key):
+        # Drops a claim so the request is processed again on retry
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class StoreWrapper(OrderStore):
+    """Base for stores that wrap another OrderStore.
+
+    Every OrderStore method is forwarded through ``_call(operation, *args)``,
+    which calls the wrapped store's method of that name; subclasses override
+    ``_call`` to add behaviour to all of them, or single methods to change
+    those. ``watch_menu`` and ``close`` go straight to the wrapped store.
+    """
+
+    def __init__(self, store):
+        self._store = store
+
+    def _call(self, operation, *args, **kwargs):
+        return getattr(self._store, operation)(*args, **kwargs)
+
+
+class FirestoreStore(OrderStore):
+    def __init__(self, service_account_path=None, orders="orders", menu="menu_prices", responses="webhook_responses",
+                 menu_version="menu_meta/version", counters="counters", order_cache=None):
+        self._service_account_path = service_account_path or os.environ.get(
+            "FIREBASE_CREDENTIALS_PATH", "/etc/secrets/servicekey.json"
+        )
+        self._orders = orders
+        self._menu = menu
+        self._responses = responses
+        self._menu_version = menu_version
+        self._counters = counters
+        # Orders with their update times, see order_cache.py
+        self._order_cache = order_cache if order_cache is not None else default_order_cache
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    self._db = initialize_firebase(self._service_account_path)
+        return self._db
+
+    def get_order(self, order_id):
+        _rpc("get_order", "read")
+        order = self.db.collection(self._orders).document(order_id).get(timeout=call_timeout())
+        if not order.exists:
+            self._order_cache.discard(order_id)
+            return None
+        self._order_cache.put(order_id, order.to_dict(), order.update_time)
+        return order.to_dict()
+
+    def set_order(self, order_id, order):
+        _rpc("set_order", "write")
+        result = self.db.collection(self._orders).document(order_id).set(order, timeout=call_timeout())
+        self._order_cache.put(order_id, order, result.update_time)
+
+    def update_order(self, order_id, fields):
+        _rpc("update_order", "write")
+        self.db.collection(self._orders).document(order_id).set(_firestore_fields(fields), merge=True, timeout=call_timeout())
+        self._order_cache.discard(order_id)
+
+    def mutate_order(self, order_id, mutate, writes=None):
+        from google.api_core.exceptions import FailedPrecondition, NotFound
+
+        order_ref = self.db.collection(self._orders).document(order_id)
+        cached = self._order_cache.get(order_id)
+        for _ in range(CONDITIONAL_ATTEMPTS):
+            fresh = cached is None
+            if fresh:
+                _rpc("mutate_order", "read")
+                snapshot = order_ref.get(timeout=call_timeout())
+                if not snapshot.exists:
+                    self._order_cache.discard(order_id)
+                    raise OrderNotFound(order_id)
+                cached = (snapshot.to_dict(), snapshot.update_time)
+            order, update_time = cached
+            try:
+                fields = mutate(copy.deepcopy(order))
+            except OrderRejected:
+                if fresh:
+                    raise
+                # The cached copy may be what's wrong; check a fresh one
+                cached = None
+                continue
+
+            # Applies only if nobody wrote the order since update_time
+            batch = self.db.batch()
+            batch.update(order_ref, _firestore_fields(fields), option=_last_update(update_time))
+            if writes is not None:
+                self._write_batch(batch, writes(order, fields))
+            _rpc("mutate_order", "conditional_write")
+            try:
+                result = batch.commit(timeout=call_timeout())[0]
+            except FailedPrecondition:
+                self._order_cache.mark_stale(order_id)
+                cached = None
+                continue
+            except NotFound:
+                self._order_cache.discard(order_id)
+                raise OrderNotFound(order_id)
+            self._order_cache.put(order_id, _with_fields(order, fields), result.update_time)
+            return fields
+
+        # Still losing races: let a transaction serialize the change
+        return self._mutate_in_transaction(order_ref, mutate, writes)
+
+    def _mutate_in_transaction(self, order_ref, mutate, writes):
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def run(transaction):
+            _rpc("mutate_order", "transaction")
+            order = order_ref.get(transaction=transaction, timeout=call_timeout())
+            if not order.exists:
+                raise OrderNotFound(order_ref.id)
+            fields = mutate(order.to_dict())
+            transaction.update(order_ref, _firestore_fields(fields))
+            if writes is not None:
+                self._write_batch(transaction, writes(order.to_dict(), fields))
+            return fields
+
+        self._order_cache.discard(order_ref.id)
+        return run(self.db.transaction())
+
+    def increment_order(self, order_id, increments, fields=None):
+        return self._commit([("increment", order_id, increments, fields)], "increment_order")[0]
+
+    def commit_writes(self, writes):
+        return self._commit(writes, "commit_writes")
+
+    def _commit(self, writes, operation):
+        from google.api_core.exceptions import FailedPrecondition
+
+        # Increments to cached orders are made conditional on the cached
+        # update time, so the copies can be kept current without a read
+        cached = self._order_cache.peek(write[1] for write in writes if write[0] == "increment")
+        if cached:
+            try:
+                return self._commit_writes(writes, cached, operation)
+            except FailedPrecondition:
+                for order_id in cached:
+                    self._order_cache.mark_stale(order_id)
+        return self._commit_writes(writes, {}, operation)
+
+    def _commit_writes(self, writes, cached, operation):
+        from google.api_core.exceptions import AlreadyExists, NotFound
+
+        batch = self._write_batch(self.db.batch(), writes, cached)
+        _rpc(operation, "conditional_write" if cached else "write")
+        try:
+            results = batch.commit(timeout=call_timeout())
+        except NotFound:
+            # The batch doesn't say which update failed
+            raise OrderNotFound(writes[0][1] if len(writes) == 1 else None)
+        except AlreadyExists:
+            raise OrderExists(writes[0][1] if len(writes) == 1 else None)
+        _cache_writes(self._order_cache, writes, results, cached)
+        return _write_results(writes, results, self.db)
+
+    def _write_batch(self, batch, writes, cached=None):
+        orders = self.db.collection(self._orders)
+        return _write_batch(batch, orders, self.db.collection(self._counters), writes, cached)
+
+    def list_orders(self, after=None, before=None, limit=100):
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        from google.cloud.firestore_v1.field_path import FieldPath
+
+        # Ordered by document ID, which needs no composite index; the
+        # cursor is a range filter on it
+        orders = self.db.collection(self._orders)
+        query = orders.order_by(FieldPath.document_id())
+        if after is not None:
+            query = query.where(filter=FieldFilter(FieldPath.document_id(), ">", orders.document(after)))
+        if before is not None:
+            query = query.where(filter=FieldFilter(FieldPath.document_id(), "<", orders.document(before)))
+        _rpc("list_orders", "read")
+        return [(doc.id, doc.to_dict()) for doc in query.limit(limit).stream(timeout=call_timeout())]
+
+    def increment_counter(self, counter_id, increments):
+        _rpc("increment_counter", "write")
+        self.db.collection(self._counters).document(counter_id).set(_counter_updates(increments), merge=True, timeout=call_timeout())
+
+    def get_counters(self, counter_ids):
+        counters = self.db.collection(self._counters)
+        _rpc("get_counters", "read")
+        docs = self.db.get_all([counters.document(counter_id) for counter_id in counter_ids], timeout=call_timeout())
+        return {doc.id: doc.to_dict() for doc in docs if doc.exists}
+
+    def get_menu(self):
+        _rpc("get_menu", "read")
+        return _menu_from_docs(self.db.collection(self._menu).get(timeout=call_timeout()))
+
+    def watch_menu(self, callback):
+        return self.db.collection(self._menu).on_snapshot(
+            lambda docs, changes, read_time: callback(_menu_from_docs(docs))
+        )
+
+    def get_menu_version(self):
+        _rpc("get_menu_version", "read")
+        version = self.db.document(self._menu_version).get(timeout=call_timeout())
+        return version.get("version") if version.exists else None
+
+    def sync_menu(self, upserts, removals):
+        from google.cloud import firestore
+        from google.cloud.firestore_v1 import _helpers
+
+        menu = self.db.collection(self._menu)
+        writes = [(menu.document(item), {"price": price}) for item, price in upserts.items()]
+        writes += [(menu.document(item), None) for item in removals]
+        # The version goes in the last batch, so anyone polling it reloads
+        # only once every item has been written
+        version_ref = self.db.document(self._menu_version)
+        writes.append((version_ref, {"version": firestore.Increment(1), "updatedAt": datetime.now(timezone.utc)}))
+        for start in range(0, len(writes), MAX_FIRESTORE_BATCH):
+            batch = self.db.batch()
+            for ref, data in writes[start:start + MAX_FIRESTORE_BATCH]:
+                if data is None:
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data, merge=ref is version_ref)
+            _rpc("sync_menu", "write")
+            results = batch.commit()
+        return _helpers.decode_value(results[-1].transform_results[0], self.db)
+
+    def claim_response(self, key, ttl):
+        from google.api_core.exceptions import AlreadyExists
+
+        response_ref = self.db.collection(self._responses).document(key)
+        try:
+            # create() fails if the document exists, so one round trip claims
+            _rpc("claim_response", "write")
+            response_ref.create(_response_record(ttl), timeout=call_timeout())
+            return None
+        except AlreadyExists:
+            _rpc("claim_response", "read")
+            record = _live_response(response_ref.get(timeout=call_timeout()).to_dict())
+        if record is None:
+            # Left over from long ago; Firestore's TTL policy on expiresAt
+            # hasn't removed it yet
+            _rpc("claim_response", "write")
+            response_ref.set(_response_record(ttl), timeout=call_timeout())
+        return record
+
+    def save_response(self, key, reply, ttl):
+        _rpc("save_response", "write")
+        self.db.collection(self._responses).document(key).set(_response_record(ttl, reply), timeout=call_timeout())
+
+    def release_response(self, key):
+        _rpc("release_response", "write")
+        self.db.collection(self._responses).document(key).delete(timeout=call_timeout())
+
+
+class MemoryStore(OrderStore):
+    def __init__(self, menu=None):
+        self._orders = {}
+        self._menu = dict(menu or {})
+        self._menu_version = None
+        self._responses = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get_order(self, order_id):
+        with self._lock:
+            order = self._orders.get(order_id)
+            return copy.deepcopy(order) if order is not None else None
+
+    def set_order(self, order_id, order):
+        with self._lock:
+            self._orders[order_id] = copy.deepcopy(order)
+
+    def update_order(self, order_id, fields):
+        with self._lock:
+            _apply_fields(self._orders.setdefault(order_id, {}), copy.deepcopy(fields))
+
+    def mutate_order(self, order_id, mutate, writes=None):
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is None:
+                raise OrderNotFound(order_id)
+            fields = mutate(copy.deepcopy(order))
+            counter_writes = writes(copy.deepcopy(order), fields) if writes is not None else ()
+            _apply_fields(order, copy.deepcopy(fields))
+            for write in counter_writes:
+                _apply_increments(self._counters.setdefault(write[1], {}), write[2], None)
+            return fields
+
+    def increment_order(self, order_id, increments, fields=None):
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is None:
+                raise OrderNotFound(order_id)
+            return _apply_increments(order, increments, copy.deepcopy(fields))
+
+    def commit_writes(self, writes):
+        with self._lock:
+            # Check first so a failed batch leaves nothing half-applied
+            for write in writes:
+                if write[0] == "increment" and write[1] not in self._orders:
+                    raise OrderNotFound(write[1])
+                if write[0] == "create" and write[1] in self._orders:
+                    raise OrderExists(write[1])
+            results = []
+            for write in writes:
+                if write[0] in ("create", "set"):
+                    self._orders[write[1]] = copy.deepcopy(write[2])
+                    results.append(None)
+                elif write[0] == "count":
+                    _apply_increments(self._counters.setdefault(write[1], {}), write[2], None)
+                    results.append(None)
+                else:
+                    results.append(_apply_increments(self._orders[write[1]], write[2], copy.deepcopy(write[3])))
+            return results
+
+    def list_orders(self, after=None, before=None, limit=100):
+        with self._lock:
+            page = heapq.nsmallest(limit, (
+                order_id for order_id in self._orders
+                if (after is None or order_id > after) and (before is None or order_id < before)
+            ))
+            return [(order_id, copy.deepcopy(self._orders[order_id])) for order_id in page]
+
+    def increment_counter(self, counter_id, increments):
+        with self._lock:
+            _apply_increments(self._counters.setdefault(counter_id, {}), increments, None)
+
+    def get_counters(self, counter_ids):
+        with self._lock:
+            return {
+                counter_id: copy.deepcopy(self._counters[counter_id])
+                for counter_id in counter_ids if counter_id in self._counters
+            }
+
+    def get_menu(self):
+        with self._lock:
+            return dict(self._menu)
+
+    def get_menu_version(self):
+        return self._menu_version
+
+    def sync_menu(self, upserts, removals):
+        with self._lock:
+            self._menu.update(upserts)
+            for item in removals:
+                self._menu.pop(item, None)
+            self._menu_version = (self._menu_version or 0) + 1
+            return self._menu_version
+
+    def claim_response(self, key, ttl):
+        with self._lock:
+            record = _live_response(self._responses.get(key))
+            if record is None:
+                self._responses[key] = _response_record(ttl)
+            return copy.deepcopy(record)
+
+    def save_response(self, key, reply, ttl):
+        with self._lock:
+            self._responses[key] = _response_record(ttl, copy.deepcopy(reply))
+
+    def release_response(self, key):
+        with self._lock:
+            self._responses.pop(key, None)
+
+
+class SqliteStore(OrderStore):
+    def __init__(self, path, menu=None):
+        self._path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS orders (order_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS menu_prices (item TEXT PRIMARY KEY, price REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS menu_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (counter_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_responses (key TEXT PRIMARY KEY, reply TEXT, expires_at REAL NOT NULL)"
+            )
+            if menu and not conn.execute("SELECT 1 FROM menu_prices LIMIT 1").fetchone():
+                conn.executemany("INSERT INTO menu_prices (item, price) VALUES (?, ?)", menu.items())
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections are not shareable
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get_order(self, order_id):
+        row = self._connect().execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_order(self, order_id, order):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO orders (order_id, data) VALUES (?, ?)",
+                (order_id, json.dumps(order)),
+            )
+
+    def update_order(self, order_id, fields):
+        self._transact(order_id, lambda order: fields, create=True)
+
+    def mutate_order(self, order_id, mutate, writes=None):
+        return self._transact(order_id, mutate, create=False, writes=writes)
+
+    def increment_order(self, order_id, increments, fields=None):
+        new_values = {}
+
+        def apply(order):
+            new_values.update(_apply_increments(order, increments, fields))
+            return order
+
+        self._transact(order_id, apply, create=False)
+        return new_values
+
+    def commit_writes(self, writes):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            results = []
+            for write in writes:
+                order_id = write[1]
+                if write[0] == "count":
+                    self._increment_counter(conn, order_id, write[2])
+                    results.append(None)
+                    continue
+                if write[0] == "create":
+                    if conn.execute("SELECT 1 FROM orders WHERE order_id = ?", (order_id,)).fetchone():
+                        raise OrderExists(order_id)
+                    order, result = write[2], None
+                elif write[0] == "set":
+                    order, result = write[2], None
+                else:
+                    row = conn.execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+                    if row is None:
+                        raise OrderNotFound(order_id)
+                    order = json.loads(row[0])
+                    result = _apply_increments(order, write[2], write[3])
+                conn.execute(
+                    "INSERT OR REPLACE INTO orders (order_id, data) VALUES (?, ?)",
+                    (order_id, json.dumps(order)),
+                )
+                results.append(result)
+            return results
+
+    def _transact(self, order_id, mutate, create, writes=None):
+        conn = self._connect()
+        with conn:
+            # Take the write lock up front so concurrent mutations serialize
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            if row is None and not create:
+                raise OrderNotFound(order_id)
+            order = json.loads(row[0]) if row else {}
+            # A deep copy: mutate() may change nested maps and then reject
+            fields = mutate(copy.deepcopy(order))
+            if writes is not None:
+                for write in writes(json.loads(row[0]) if row else {}, fields):
+                    self._increment_counter(conn, write[1], write[2])
+            _apply_fields(order, fields)
+            conn.execute(
+                "INSERT OR REPLACE INTO orders (order_id, data) VALUES (?, ?)",
+                (order_id, json.dumps(order)),
+            )
+            return fields
+
+    def list_orders(self, after=None, before=None, limit=100):
+        # A range scan of the primary key index
+        where, args = [], []
+        if after is not None:
+            where.append("order_id > ?")
+            args.append(after)
+        if before is not None:
+            where.append("order_id < ?")
+            args.append(before)
+        rows = self._connect().execute(
+            "SELECT order_id, data FROM orders"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY order_id LIMIT ?",
+            (*args, limit),
+        )
+        return [(order_id, json.loads(data)) for order_id, data in rows]
+
+    def increment_counter(self, counter_id, increments):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._increment_counter(conn, counter_id, increments)
+
+    def _increment_counter(self, conn, counter_id, increments):
+        row = conn.execute("SELECT data FROM counters WHERE counter_id = ?", (counter_id,)).fetchone()
+        counter = json.loads(row[0]) if row else {}
+        _apply_increments(counter, increments, None)
+        conn.execute(
+            "INSERT OR REPLACE INTO counters (counter_id, data) VALUES (?, ?)",
+            (counter_id, json.dumps(counter)),
+        )
+
+    def get_counters(self, counter_ids):
+        counter_ids = list(counter_ids)
+        rows = self._connect().execute(
+            f"SELECT counter_id, data FROM counters WHERE counter_id IN ({', '.join('?' * len(counter_ids))})",
+            counter_ids,
+        ).fetchall()
+        return {counter_id: json.loads(data) for counter_id, data in rows}
+
+    def get_menu(self):
+        rows = self._connect().execute("SELECT item, price FROM menu_prices").fetchall()
+        return {item: _sqlite_number(price) for item, price in rows}
+
+    def get_menu_version(self):
+        row = self._connect().execute("SELECT version FROM menu_version WHERE id = 0").fetchone()
+        return row[0] if row else None
+
+    def sync_menu(self, upserts, removals):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR REPLACE INTO menu_prices (item, price) VALUES (?, ?)", upserts.items())
+            conn.executemany("DELETE FROM menu_prices WHERE item = ?", [(item,) for item in removals])
+            conn.execute(
+                "INSERT INTO menu_version (id, version) VALUES (0, 1) "
+                "ON CONFLICT (id) DO UPDATE SET version = version + 1"
+            )
+            return conn.execute("SELECT version FROM menu_version WHERE id = 0").fetchone()[0]
+
+    def claim_response(self, key, ttl):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT reply FROM webhook_responses WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+            if row is not None:
+                return {"reply": json.loads(row[0])} if row[0] is not None else {}
+            conn.execute(
+                "INSERT OR REPLACE INTO webhook_responses (key, reply, expires_at) VALUES (?, NULL, ?)",
+                (key, time.time() + ttl),
+            )
+            return None
+
+    def save_response(self, key, reply, ttl):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO webhook_responses (key, reply, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(reply), time.time() + ttl),
+            )
+
+    def release_response(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM webhook_responses WHERE key = ?", (key,))
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class AsyncOrderStore:
+    """Coroutine counterpart of OrderStore for the ASGI webhook.
+
+    Menu reads go through ``menu_store``, a synchronous OrderStore, since
+    they are served from MenuCache.
+    """
+
+    menu_store = None
+
+    async def get_order(self, order_id):
+        raise NotImplementedError
+
+    async def set_order(self, order_id, order):
+        raise NotImplementedError
+
+    async def mutate_order(self, order_id, mutate, prefetch=None, writes=None):
+        # As OrderStore.mutate_order. prefetch is an optional function
+        # returning an awaitable for data mutate() needs, such as menu
+        # prices; it is called once the store takes the call, awaited
+        # alongside the order read and its result passed to mutate() as a
+        # second argument.
+        raise NotImplementedError
+
+    async def increment_order(self, order_id, increments, fields=None):
+        raise NotImplementedError
+
+    async def commit_writes(self, writes):
+        # As OrderStore.commit_writes
+        results = []
+        for write in writes:
+            if write[0] == "create":
+                if await self.get_order(write[1]) is not None:
+                    raise OrderExists(write[1])
+                results.append(await self.set_order(write[1], write[2]))
+            elif write[0] == "set":
+                results.append(await self.set_order(write[1], write[2]))
+            elif write[0] == "count":
+                results.append(await self.increment_counter(write[1], write[2]))
+            else:
+                results.append(await self.increment_order(*write[1:]))
+        return results
+
+    async def increment_counter(self, counter_id, increments):
+        raise NotImplementedError
+
+    async def claim_response(self, key, ttl):
+        raise NotImplementedError
+
+    async def save_response(self, key, reply, ttl):
+        raise NotImplementedError
+
+    async def release_response(self, key):
+        raise NotImplementedError
+
+    async def warm_up(self):
+        # Open connections ahead of the first request
+        pass
+
+    async def close(self):
+        pass
+
+
+class AsyncStoreWrapper(AsyncOrderStore):
+    # StoreWrapper for AsyncOrderStore: every method is awaited through
+    # _call, but warm_up and close, which go straight to the wrapped store.
+    # Subclasses set menu_store.
+
+    def __init__(self, store):
+        self._store = store
+
+    async def _call(self, operation, *args, **kwargs):
+        return await getattr(self._store, operation)(*args, **kwargs)
+
+
+class AsyncFirestoreStore(AsyncOrderStore):
+    def __init__(self, service_account_path=None, orders="orders", menu="menu_prices", responses="webhook_responses",
+                 counters="counters", order_cache=None):
+        self._service_account_path = service_account_path or os.environ.get(
+            "FIREBASE_CREDENTIALS_PATH", "/etc/secrets/servicekey.json"
+        )
+        self._orders = orders
+        self._responses = responses
+        self._counters = counters
+        self._order_cache = order_cache if order_cache is not None else default_order_cache
+        self._db = None
+        self.menu_store = FirestoreStore(
+            self._service_account_path, orders=orders, menu=menu, responses=responses, counters=counters,
+            order_cache=self._order_cache,
+        )
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = initialize_firebase(self._service_account_path, async_client=True)
+        return self._db
+
+    async def get_order(self, order_id):
+        _rpc("get_order", "read")
+        order = await self.db.collection(self._orders).document(order_id).get(timeout=call_timeout())
+        if not order.exists:
+            self._order_cache.discard(order_id)
+            return None
+        self._order_cache.put(order_id, order.to_dict(), order.update_time)
+        return order.to_dict()
+
+    async def set_order(self, order_id, order):
+        _rpc("set_order", "write")
+        result = await self.db.collection(self._orders).document(order_id).set(order, timeout=call_timeout())
+        self._order_cache.put(order_id, order, result.update_time)
+
+    async def mutate_order(self, order_id, mutate, prefetch=None, writes=None):
+        # As FirestoreStore.mutate_order; prefetch runs alongside the read
+        from google.api_core.exceptions import FailedPrecondition, NotFound
+
+        order_ref = self.db.collection(self._orders).document(order_id)
+        # A task can be awaited again on retry
+        prefetch = asyncio.ensure_future(prefetch()) if prefetch is not None else None
+        cached = self._order_cache.get(order_id)
+        for _ in range(CONDITIONAL_ATTEMPTS):
+            fresh = cached is None
+            if fresh:
+                _rpc("mutate_order", "read")
+                snapshot = await order_ref.get(timeout=call_timeout())
+                if not snapshot.exists:
+                    self._order_cache.discard(order_id)
+                    raise OrderNotFound(order_id)
+                cached = (snapshot.to_dict(), snapshot.update_time)
+            order, update_time = cached
+            try:
+                if prefetch is None:
+                    fields = mutate(copy.deepcopy(order))
+                else:
+                    fields = mutate(copy.deepcopy(order), await prefetch)
+            except OrderRejected:
+                if fresh:
+                    raise
+                cached = None
+                continue
+
+            batch = self.db.batch()
+            batch.update(order_ref, _firestore_fields(fields), option=_last_update(update_time))
+            if writes is not None:
+                self._write_batch(batch, writes(order, fields))
+            _rpc("mutate_order", "conditional_write")
+            try:
+                result = (await batch.commit(timeout=call_timeout()))[0]
+            except FailedPrecondition:
+                self._order_cache.mark_stale(order_id)
+                cached = None
+                continue
+            except NotFound:
+                self._order_cache.discard(order_id)
+                raise OrderNotFound(order_id)
+            self._order_cache.put(order_id, _with_fields(order, fields), result.update_time)
+            return fields
+
+        return await self._mutate_in_transaction(order_ref, mutate, prefetch, writes)
+
+    async def _mutate_in_transaction(self, order_ref, mutate, prefetch, writes):
+        from google.cloud import firestore
+
+        order_id = order_ref.id
+
+        @firestore.async_transactional
+        async def run(transaction):
+            _rpc("mutate_order", "transaction")
+            if prefetch is None:
+                order = await order_ref.get(transaction=transaction, timeout=call_timeout())
+            else:
+                order, prefetched = await asyncio.gather(order_ref.get(transaction=transaction, timeout=call_timeout()), prefetch)
+            if not order.exists:
+                raise OrderNotFound(order_id)
+            fields = mutate(order.to_dict()) if prefetch is None else mutate(order.to_dict(), prefetched)
+            transaction.update(order_ref, _firestore_fields(fields))
+            if writes is not None:
+                self._write_batch(transaction, writes(order.to_dict(), fields))
+            return fields
+
+        self._order_cache.discard(order_id)
+        return await run(self.db.transaction())
+
+    async def increment_order(self, order_id, increments, fields=None):
+        return (await self._commit([("increment", order_id, increments, fields)], "increment_order"))[0]
+
+    async def commit_writes(self, writes):
+        return await self._commit(writes, "commit_writes")
+
+    async def _commit(self, writes, operation):
+        from google.api_core.exceptions import FailedPrecondition
+
+        cached = self._order_cache.peek(write[1] for write in writes if write[0] == "increment")
+        if cached:
+            try:
+                return await self._commit_writes(writes, cached, operation)
+            except FailedPrecondition:
+                for order_id in cached:
+                    self._order_cache.mark_stale(order_id)
+        return await self._commit_writes(writes, {}, operation)
+
+    async def _commit_writes(self, writes, cached, operation):
+        from google.api_core.exceptions import AlreadyExists, NotFound
+
+        batch = self._write_batch(self.db.batch(), writes, cached)
+        _rpc(operation, "conditional_write" if cached else "write")
+        try:
+            results = await batch.commit(timeout=call_timeout())
+        except NotFound:
+            raise OrderNotFound(writes[0][1] if len(writes) == 1 else None)
+        except AlreadyExists:
+            raise OrderExists(writes[0][1] if len(writes) == 1 else None)
+        _cache_writes(self._order_cache, writes, results, cached)
+        return _write_results(writes, results, self.db)
+
+    def _write_batch(self, batch, writes, cached=None):
+        orders = self.db.collection(self._orders)
+        return _write_batch(batch, orders, self.db.collection(self._counters), writes, cached)
+
+    async def increment_counter(self, counter_id, increments):
+        _rpc("increment_counter", "write")
+        await self.db.collection(self._counters).document(counter_id).set(_counter_updates(increments), merge=True, timeout=call_timeout())
+
+    async def claim_response(self, key, ttl):
+        from google.api_core.exceptions import AlreadyExists
+
+        response_ref = self.db.collection(self._responses).document(key)
+        try:
+            _rpc("claim_response", "write")
+            await response_ref.create(_response_record(ttl), timeout=call_timeout())
+            return None
+        except AlreadyExists:
+            _rpc("claim_response", "read")
+            record = _live_response((await response_ref.get(timeout=call_timeout())).to_dict())
+        if record is None:
+            _rpc("claim_response", "write")
+            await response_ref.set(_response_record(ttl), timeout=call_timeout())
+        return record
+
+    async def save_response(self, key, reply, ttl):
+        _rpc("save_response", "write")
+        await self.db.collection(self._responses).document(key).set(_response_record(ttl, reply), timeout=call_timeout())
+
+    async def release_response(self, key):
+        _rpc("release_response", "write")
+        await self.db.collection(self._responses).document(key).delete(timeout=call_timeout())
+
+    async def warm_up(self):
+        # The async client's channel is bound to the running loop, so it
+        # has to be created from inside it
+        self.db
+
+    async def close(self):
+        if self._db is not None:
+            self._db.close()
+
+
+class SyncStoreAdapter(AsyncStoreWrapper):
+    # Serves a synchronous store to async callers. Blocking backends run on
+    # the default executor; in-memory ones are cheap enough to call inline.
+
+    def __init__(self, store, inline=False):
+        super().__init__(store)
+        self.menu_store = store
+        self._inline = inline
+
+    async def _call(self, operation, *args, **kwargs):
+        method = getattr(self._store, operation)
+        if self._inline:
+            return method(*args, **kwargs)
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+    async def mutate_order(self, order_id, mutate, prefetch=None, writes=None):
+        # The local stores lock for the whole mutation, so resolve prefetch
+        # before taking the lock rather than alongside the read
+        if prefetch is not None:
+            prefetched = await prefetch()
+            return await self._call("mutate_order", order_id, lambda order: mutate(order, prefetched), writes)
+        return await self._call("mutate_order", order_id, mutate, writes)
+
+    async def warm_up(self):
+        pass
+
+    async def close(self):
+        await self._call("close")
+
+
+def initialize_firebase(service_account_path, async_client=False):
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    try:
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(service_account_path)
+            firebase_admin.initialize_app(cred)
+
+        if async_client:
+            from firebase_admin import firestore_async
+
+            return firestore_async.client()
+        return firestore.client()
+    except Exception as e:
+        logging.error(f"Failed to initialize Firebase: {e}")
+        raise
+
+
+def create_store(backend=None):
+    backend = (backend or os.environ.get("ORDER_STORE", "firestore")).lower()
+
+    if backend == "firestore":
+        return FirestoreStore()
+    if backend in ("memory", "sqlite"):
+        from initialize_menu import MENU_PRICES
+
+        if backend == "memory":
+            return MemoryStore(menu=MENU_PRICES)
+        return SqliteStore(os.environ.get("ORDER_STORE_PATH", "orders.db"), menu=MENU_PRICES)
+    raise ValueError(f"Unknown ORDER_STORE backend: {backend}")
+
+
+def create_async_store(backend=None):
+    backend = (backend or os.environ.get("ORDER_STORE", "firestore")).lower()
+
+    if backend == "firestore":
+        return AsyncFirestoreStore()
+    return SyncStoreAdapter(create_store(backend), inline=backend == "memory")
+
+
+def _increment_updates(increments, fields):
+    from google.cloud import firestore
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    updates = {FieldPath(*path).to_api_repr(): value for path, value in (fields or {}).items()}
+    for path, delta in increments.items():
+        updates[FieldPath(*path).to_api_repr()] = firestore.Increment(delta)
+    return updates
+
+
+def _increment_results(increments, result, client):
+    from google.cloud.firestore_v1 import _helpers
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    # The commit returns transformed values in field-path order
+    paths = sorted(increments, key=lambda path: FieldPath(*path))
+    return {
+        path: _helpers.decode_value(value, client)
+        for path, value in zip(paths, result.transform_results)
+    }
+
+
+def _apply_fields(order, fields):
+    for name, value in fields.items():
+        if value is DELETE_FIELD:
+            order.pop(name, None)
+        else:
+            order[name] = value
+
+
+def _apply_increments(order, increments, fields):
+    for path, value in (fields or {}).items():
+        parent = order
+        for part in path[:-1]:
+            parent = parent.setdefault(part, {})
+        parent[path[-1]] = value
+
+    new_values = {}
+    for path, delta in increments.items():
+        parent = order
+        for part in path[:-1]:
+            parent = parent.setdefault(part, {})
+        parent[path[-1]] = new_values[path] = parent.get(path[-1], 0) + delta
+    return new_values
+
+
+def _firestore_fields(fields):
+    from google.cloud import firestore
+
+    return {
+        name: firestore.DELETE_FIELD if value is DELETE_FIELD else value
+        for name, value in fields.items()
+    }
+
+
+def _apply_write(store, write):
+    # Backends without batches: each write on its own, and a create only
+    # checked, not guarded
+    if write[0] == "create":
+        if store.get_order(write[1]) is not None:
+            raise OrderExists(write[1])
+        return store.set_order(write[1], write[2])
+    if write[0] == "set":
+        return store.set_order(write[1], write[2])
+    if write[0] == "count":
+        return store.increment_counter(write[1], write[2])
+    return store.increment_order(*write[1:])
+
+
+def _write_batch(batch, orders, counters, writes, cached=None):
+    # Also fills a transaction, which takes the same calls. Increments to
+    # orders in cached ({order_id: (order, update time)}) only apply if the
+    # order is still at that update time.
+    for write in writes:
+        if write[0] == "create":
+            # Fails the commit if the ID is taken, rather than overwriting
+            batch.create(orders.document(write[1]), write[2])
+        elif write[0] == "set":
+            batch.set(orders.document(write[1]), write[2])
+        elif write[0] == "count":
+            batch.set(counters.document(write[1]), _counter_updates(write[2]), merge=True)
+        else:
+            entry = (cached or {}).get(write[1])
+            option = _last_update(entry[1]) if entry is not None else None
+            batch.update(orders.document(write[1]), _increment_updates(write[2], write[3]), option=option)
+    return batch
+
+
+def _last_update(update_time):
+    from google.cloud.firestore_v1._helpers import LastUpdateOption
+
+    return LastUpdateOption(update_time)
+
+
+def _rpc(operation, kind):
+    if rpc_observer is not None:
+        rpc_observer(operation, kind)
+
+
+def _cache_writes(cache, writes, results, cached):
+    # Brings the order cache up to date after a commit; an increment is
+    # applied to the cached copy only if it was conditional on that copy
+    for write, result in zip(writes, results):
+        if write[0] in ("create", "set"):
+            cache.put(write[1], write[2], result.update_time)
+        elif write[0] == "increment" and write[1] in cached:
+            order = copy.deepcopy(cached[write[1]][0])
+            _apply_increments(order, write[2], copy.deepcopy(write[3]))
+            cache.put(write[1], order, result.update_time)
+
+
+def _with_fields(order, fields):
+    order = copy.deepcopy(order)
+    _apply_fields(order, copy.deepcopy(fields))
+    return order
+
+
+def _write_results(writes, results, client):
+    return [
+        _increment_results(write[2], result, client) if write[0] == "increment" else None
+        for write, result in zip(writes, results)
+    ]
+
+
+def _counter_updates(increments):
+    # A merge set rather than an update, so a new counter document is
+    # created; merge sets take nested maps, not field paths
+    from google.cloud import firestore
+
+    updates = {}
+    for path, delta in increments.items():
+        parent = updates
+        for part in path[:-1]:
+            parent = parent.setdefault(part, {})
+        parent[path[-1]] = firestore.Increment(delta)
+    return updates
+
+
+def _response_record(ttl, reply=None):
+    # expiresAt is a timestamp so a Firestore TTL policy can delete old records
+    record = {"expiresAt": datetime.now(timezone.utc) + timedelta(seconds=ttl)}
+    if reply is not None:
+        record["reply"] = reply
+    return record
+
+
+def _live_response(record):
+    # The part of a stored record claim_response returns, or None if expired
+    if record is None or record["expiresAt"] <= datetime.now(timezone.utc):
+        return None
+    return {"reply": record["reply"]} if "reply" in record else {}
+
+
+def _menu_from_docs(docs):
+    return {doc.id: (doc.to_dict() or {}).get("price") for doc in docs}
+
+
+def _sqlite_number(value):
+    # SQLite hands REAL columns back as floats; keep whole prices as ints
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _forward(operation):
+    def forward(self, *args, **kwargs):
+        return self._call(operation, *args, **kwargs)
+    forward.__name__ = operation
+    return forward
+
+
+def _forward_async(operation):
+    async def forward(self, *args, **kwargs):
+        return await self._call(operation, *args, **kwargs)
+    forward.__name__ = operation
+    return forward
+
+
+def _direct(operation):
+    def forward(self, *args, **kwargs):
+        return getattr(self._store, operation)(*args, **kwargs)
+    forward.__name__ = operation
+    return forward
+
+
+def _direct_async(operation):
+    async def forward(self, *args, **kwargs):
+        return await getattr(self._store, operation)(*args, **kwargs)
+    forward.__name__ = operation
+    return forward
+
+
+def _wrap_interface(wrapper, interface, direct, forward, forward_direct):
+    # Gives wrapper a forwarding method for each public method of interface,
+    # so a method added to the interface reaches every wrapper
+    for name, value in vars(interface).items():
+        if callable(value) and not name.startswith("_"):
+            setattr(wrapper, name, forward_direct(name) if name in direct else forward(name))
+
+
+_wrap_interface(StoreWrapper, OrderStore, ("watch_menu", "close"), _forward, _direct)
+_wrap_interface(AsyncStoreWrapper, AsyncOrderStore, ("warm_up", "close"), _forward_async, _direct_async)
@@ -0,0 +1,438 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+import deadlines
+from collections import deque
+from circuit_breaker import StoreUnavailable
+from storage import MAX_FIRESTORE_BATCH, AsyncStoreWrapper, OrderExists, OrderNotFound, StoreWrapper
+
+# Group commit for order writes. set_order, increment_order and
+# commit_writes calls from concurrent requests are queued, held for a few
+# milliseconds so others can join, and committed together with one
+# commit_writes call (a Firestore WriteBatch). A caller's own writes always
+# share a commit, and increments to the same counter are summed into one
+# write. Each caller returns only once its batch has committed, so a reply
+# never gets ahead of its write. If its request's deadline (see
+# deadlines.py) passes first, a write still queued is withdrawn and the
+# caller gets StoreUnavailable; one already being committed may yet be
+# applied, and the caller gets WriteOutcomeUnknown. Reads and transactions
+# go straight to the wrapped store.
+#
+#   WRITE_BEHIND                  1 to enable in app.py / asgi.py
+#   WRITE_BEHIND_WINDOW_MS        how long a batch waits for more writes (default 5)
+#   WRITE_BEHIND_MAX_BATCH        writes per commit (default 100, Firestore allows 500)
+#   WRITE_BEHIND_QUEUE            writes waiting to commit before callers block (default 1000)
+#   WRITE_BEHIND_ENQUEUE_TIMEOUT  seconds a caller blocks on a full queue (default 1)
+#   WRITE_BEHIND_COMMITTERS       commits in flight at once (default 2)
+
+
+class WriteQueueFull(Exception):
+    # Backpressure: the store is falling behind and the write was refused
+    pass
+
+
+class WriteOutcomeUnknown(Exception):
+    # The request's deadline passed while the write was being committed;
+    # it may or may not have been applied, so it must not be retried blind
+    pass
+
+
+class _Settings:
+    def __init__(self, window, max_batch, max_queue, enqueue_timeout, committers):
+        env = os.environ.get
+        self.window = float(window if window is not None else env("WRITE_BEHIND_WINDOW_MS", 5)) / 1000
+        self.max_batch = min(int(max_batch if max_batch is not None else env("WRITE_BEHIND_MAX_BATCH", 100)), MAX_FIRESTORE_BATCH)
+        self.max_queue = int(max_queue if max_queue is not None else env("WRITE_BEHIND_QUEUE", 1000))
+        self.enqueue_timeout = float(enqueue_timeout if enqueue_timeout is not None else env("WRITE_BEHIND_ENQUEUE_TIMEOUT", 1))
+        self.committers = int(committers if committers is not None else env("WRITE_BEHIND_COMMITTERS", 2))
+
+
+def _rounds(batch, max_writes, writes_of=lambda pending: pending.writes):
+    # Splits a batch into commits of at most max_writes writes with no
+    # order written twice in one; an order's writes stay in the order they
+    # were submitted. Counter increments commute and are merged by _merged,
+    # so they never force a split.
+    rounds = []
+    sizes = []
+    last_round = {}
+    for pending in batch:
+        writes = writes_of(pending)
+        order_ids = [write[1] for write in writes if write[0] != "count"]
+        index = max((last_round.get(order_id, -1) for order_id in order_ids), default=-1) + 1
+        while index < len(rounds) and sizes[index] + len(writes) > max_writes:
+            index += 1
+        if index == len(rounds):
+            rounds.append([])
+            sizes.append(0)
+        rounds[index].append(pending)
+        sizes[index] += len(writes)
+        for order_id in order_ids:
+            last_round[order_id] = index
+    return rounds
+
+
+def _merged(units):
+    # The writes of several callers as one commit_writes list, with the
+    # increments to each counter summed; also returns, per caller, the
+    # positions of its results
+    writes = []
+    positions = []
+    counters = {}
+    for unit in units:
+        unit_positions = []
+        for write in unit:
+            if write[0] == "count":
+                index = counters.get(write[1])
+                if index is not None:
+                    increments = writes[index][2]
+                    for path, delta in write[2].items():
+                        increments[path] = increments.get(path, 0) + delta
+                    unit_positions.append(index)
+                    continue
+                counters[write[1]] = len(writes)
+                write = ("count", write[1], dict(write[2]))
+            unit_positions.append(len(writes))
+            writes.append(write)
+        positions.append(unit_positions)
+    return writes, positions
+
+
+class _Write:
+    # One caller's writes, committed together
+    __slots__ = ("writes", "done", "result", "error")
+
+    def __init__(self, writes):
+        self.writes = writes
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class GroupCommitStore(StoreWrapper):
+    def __init__(self, store, window=None, max_batch=None, max_queue=None, enqueue_timeout=None, committers=None):
+        super().__init__(store)
+        self._settings = _Settings(window, max_batch, max_queue, enqueue_timeout, committers)
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._queue = deque()
+        self._closed = False
+        self._threads = []
+        self._pid = None
+        self.batches = 0
+        self.writes = 0
+        self.rejected = 0
+
+    def set_order(self, order_id, order):
+        self._submit([("set", order_id, order)])
+
+    def increment_order(self, order_id, increments, fields=None):
+        return self._submit([("increment", order_id, increments, fields)])[0]
+
+    def commit_writes(self, writes):
+        return self._submit(list(writes))
+
+    def increment_counter(self, counter_id, increments):
+        self._submit([("count", counter_id, increments)])
+
+    def stats(self):
+        return {"queued": len(self._queue), "batches": self.batches, "writes": self.writes, "rejected": self.rejected}
+
+    def close(self):
+        # Commits everything already queued, then closes the wrapped store
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        if self._pid == os.getpid():
+            for thread in self._threads:
+                thread.join()
+        self._store.close()
+
+    def _submit(self, writes):
+        pending = _Write(writes)
+        settings = self._settings
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Write-behind store is closed")
+            if self._pid != os.getpid():
+                # Started on first use so gunicorn workers each get their own
+                self._start()
+            deadline = time.monotonic() + settings.enqueue_timeout
+            while len(self._queue) >= settings.max_queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise WriteQueueFull(f"{len(self._queue)} order writes waiting to commit")
+                self._not_full.wait(remaining)
+            self._queue.append(pending)
+            self._not_empty.notify()
+        if not pending.done.wait(deadlines.remaining()):
+            with self._lock:
+                if pending in self._queue:
+                    self._queue.remove(pending)
+                    self._not_full.notify()
+                    raise StoreUnavailable("Request deadline passed before the order write was sent")
+                if not pending.done.is_set():
+                    raise WriteOutcomeUnknown("Request deadline passed while the order write was committing")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"write-behind-{i}", daemon=True)
+            for i in range(self._settings.committers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        settings = self._settings
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return
+                # Hold the batch open briefly so concurrent requests join it
+                deadline = time.monotonic() + settings.window
+                while len(self._queue) < settings.max_batch and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._not_empty.wait(remaining)
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), settings.max_batch))]
+                self._not_full.notify(len(batch))
+            for writes in _rounds(batch, settings.max_batch):
+                self._commit(writes)
+
+    def _commit(self, batch):
+        writes, positions = _merged([pending.writes for pending in batch])
+        try:
+            results = self._store.commit_writes(writes)
+        except (OrderNotFound, OrderExists) as e:
+            if len(batch) == 1:
+                batch[0].finish(error=e)
+                return
+            # One unknown or duplicate order fails the whole batch; commit
+            # each caller's writes on their own so each gets its own outcome
+            for pending in batch:
+                self._commit([pending])
+            return
+        except Exception as e:
+            logging.error("Failed to commit %d order writes: %s", len(writes), e)
+            for pending in batch:
+                pending.finish(error=e)
+            return
+        self.batches += 1
+        self.writes += len(writes)
+        for pending, unit_positions in zip(batch, positions):
+            pending.finish([results[i] for i in unit_positions])
+
+
+class AsyncGroupCommitStore(AsyncStoreWrapper):
+    # GroupCommitStore for the ASGI webhook; the committers are tasks on
+    # the worker's event loop
+
+    def __init__(self, store, window=None, max_batch=None, max_queue=None, enqueue_timeout=None, committers=None):
+        super().__init__(store)
+        self.menu_store = store.menu_store
+        self._settings = _Settings(window, max_batch, max_queue, enqueue_timeout, committers)
+        self._queue = None
+        self._tasks = []
+        # Futures of the writes being committed
+        self._committing = set()
+        self._closed = False
+        self.batches = 0
+        self.writes = 0
+        self.rejected = 0
+
+    async def set_order(self, order_id, order):
+        await self._submit([("set", order_id, order)])
+
+    async def increment_order(self, order_id, increments, fields=None):
+        return (await self._submit([("increment", order_id, increments, fields)]))[0]
+
+    async def commit_writes(self, writes):
+        return await self._submit(list(writes))
+
+    async def increment_counter(self, counter_id, increments):
+        await self._submit([("count", counter_id, increments)])
+
+    def stats(self):
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return {"queued": queued, "batches": self.batches, "writes": self.writes, "rejected": self.rejected}
+
+    async def close(self):
+        self._closed = True
+        if self._queue is not None:
+            await self._queue.join()
+            for task in self._tasks:
+                task.cancel()
+        await self._store.close()
+
+    async def _submit(self, writes):
+        if self._closed:
+            raise RuntimeError("Write-behind store is closed")
+        if self._queue is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        if self._queue.full():
+            try:
+                await asyncio.wait_for(self._queue.put((writes, future)), self._settings.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise WriteQueueFull(f"{self._queue.qsize()} order writes waiting to commit")
+        else:
+            self._queue.put_nowait((writes, future))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Cancelled at the request's deadline (GuardedAsyncStore); a
+            # write still queued is skipped, see _run
+            if future in self._committing:
+                raise WriteOutcomeUnknown("Request deadline passed while the order write was committing")
+            raise StoreUnavailable("Request deadline passed before the order write was sent")
+
+    def _start(self):
+        self._queue = asyncio.Queue(self._settings.max_queue)
+        # In a fresh context so no request's context variables leak into them
+        self._tasks = [
+            contextvars.Context().run(asyncio.create_task, self._run()) for _ in range(self._settings.committers)
+        ]
+
+    async def _run(self):
+        settings = self._settings
+        while True:
+            batch = [await self._queue.get()]
+            if settings.window:
+                await asyncio.sleep(settings.window)
+            while len(batch) < settings.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            live = [item for item in batch if not item[1].cancelled()]
+            self._committing.update(future for _, future in live)
+            try:
+                for items in _rounds(live, settings.max_batch, writes_of=lambda item: item[0]):
+                    await self._commit(items)
+            finally:
+                self._committing.difference_update(future for _, future in live)
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _commit(self, batch):
+        writes, positions = _merged([unit for unit, _ in batch])
+        try:
+            results = await self._store.commit_writes(writes)
+        except (OrderNotFound, OrderExists) as e:
+            if len(batch) == 1:
+                _set_exception(batch[0][1], e)
+                return
+            for item in batch:
+                await self._commit([item])
+            return
+        except Exception as e:
+            logging.error("Failed to commit %d order writes: %s", len(writes), e)
+            for _, future in batch:
+                _set_exception(future, e)
+            return
+        self.batches += 1
+        self.writes += len(writes)
+        for (_, future), unit_positions in zip(batch, positions):
+            if not future.done():
+                future.set_result([results[i] for i in unit_positions])
+
+
+# Orders taken while the store was unavailable (see circuit_breaker.py),
+# saved in the order they came once it is back. The queue lives in memory:
+# orders still in it when the process exits are lost, and logged as such.
+# A write that times out may have been applied all the same; its retry
+# then finds the order already created and is dropped.
+#
+#   DEFERRED_WRITES_MAX           orders held before new ones are refused (default 1000)
+#   DEFERRED_WRITES_INTERVAL      seconds between attempts to save them (default 5)
+
+
+class DeferredWrites:
+    def __init__(self, store, max_queue=None, interval=None):
+        self._store = store
+        self._max_queue = int(max_queue if max_queue is not None else os.environ.get("DEFERRED_WRITES_MAX", 1000))
+        self._interval = float(interval if interval is not None else os.environ.get("DEFERRED_WRITES_INTERVAL", 5))
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.saved = 0
+        self.refused = 0
+
+    def submit(self, writes):
+        # Queues a commit_writes list; False if the queue is full
+        with self._lock:
+            if self._stop.is_set() or len(self._queue) >= self._max_queue:
+                self.refused += 1
+                return False
+            if self._pid != os.getpid():
+                self._start()
+            self._queue.append(list(writes))
+        return True
+
+    def flush(self):
+        # Saves queued writes until one fails; returns how many are left.
+        # Only the background thread calls this, and close() once it's gone.
+        while True:
+            with self._lock:
+                if not self._queue:
+                    return 0
+                writes = self._queue[0]
+            try:
+                self._store.commit_writes(writes)
+            except OrderExists:
+                # Saved by an earlier attempt that timed out, or the ID was
+                # taken: either way retrying can't save it
+                logging.error("Deferred order already exists, dropped", extra={"order_id": writes[0][1]})
+                with self._lock:
+                    self._queue.popleft()
+                continue
+            except Exception as e:
+                logging.debug("Deferred order writes not saved yet: %s", e)
+                return len(self._queue)
+            with self._lock:
+                self._queue.popleft()
+                self.saved += 1
+            logging.info("Deferred order saved", extra={"order_id": writes[0][1]})
+
+    def stats(self):
+        return {"queued": len(self._queue), "saved": self.saved, "refused": self.refused}
+
+    def close(self):
+        # One last attempt, after which anything still queued is lost
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        left = self.flush()
+        if left:
+            logging.error("%d deferred orders could not be saved", left)
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="deferred-writes", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.flush()
+
+
+def _set_exception(future, error):
+    if not future.done():
+        future.set_exception(error)